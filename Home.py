@@ -1,5 +1,7 @@
 import streamlit as st
-import leafmap.foliumap as leafmap
+import streamlit.components.v1 as components
+import folium
+from folium.plugins import MiniMap
 
 # Set page configuration
 st.set_page_config(layout="wide", page_title="Home", page_icon="👋")
@@ -20,9 +22,15 @@ This is an interactive web application created using [Streamlit](https://streaml
 - **Second Page**: Utilizes a pre-trained model using data from Oxnard, Santa Maria, Mendocino, and Watsonville, with additional feature engineering to perform classification and visualization.
 """)
 
-# Leafmap Map Object
-m = leafmap.Map(minimap_control=True)
-m.add_basemap("OpenTopoMap")
+# Folium Map Object (plain folium keeps the shapefile stack out of the home page)
+m = folium.Map(location=[20, 0], zoom_start=2)
+folium.TileLayer(
+    tiles="https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png",
+    attr="Map data: &copy; OpenStreetMap contributors, SRTM | Map style: &copy; OpenTopoMap (CC-BY-SA)",
+    name="OpenTopoMap",
+).add_to(m)
+MiniMap().add_to(m)
+folium.LayerControl().add_to(m)
 
 # Displaying the map in Streamlit
-m.to_streamlit(height=500)
+components.html(m.get_root().render(), height=500)
@@ -0,0 +1,643 @@
+import os
+import glob
+import zipfile
+from datetime import datetime as dt
+
+import numpy as np
+
+import app.fnc as fnc
+import app.counties as ca_counties
+from app import indices, composites
+from app.forest import RandomForest, forest_labels, forest_from_ee
+from app.store import BandStore, STORE_MAX_BYTES, bounds_window, window_transform, filter_headers
+from app.lazy import lazy_import
+from app.session import client as ee
+
+pd = lazy_import('pandas')
+
+# Compute backends for the operations the pipeline needs. EEBackend runs
+# everything on Earth Engine; LocalBackend reads raster stacks from disk so the
+# pipeline can run offline, in tests and in benchmarks.
+# Select one per run with TNC_BACKEND=ee|local (and TNC_LOCAL_DATA=<folder>).
+
+
+class Backend:
+    name = None
+    # Other backends whose model artifacts import_model accepts
+    imports_from = ()
+
+    def rectangle(self, bounds):
+        raise NotImplementedError
+
+    def rectangles(self, bounds_list):
+        raise NotImplementedError
+
+    def points(self, df):
+        raise NotImplementedError
+
+    def feature_collection(self, features):
+        raise NotImplementedError
+
+    def merge(self, collections):
+        raise NotImplementedError
+
+    def composite(self, collection_id, roi, start, end, cloud=20, method='median', percentile=50, bands=None):
+        raise NotImplementedError
+
+    def sample_regions(self, image, collection, bands=None, properties=('class',), scale=30):
+        raise NotImplementedError
+
+    def size(self, collection):
+        raise NotImplementedError
+
+    def train_rf(self, numtrees, data, bands):
+        raise NotImplementedError
+
+    def classify(self, image, model, bands):
+        raise NotImplementedError
+
+    def classify_tile(self, image, model, bands, bounds, shape, step):
+        raise NotImplementedError
+
+    def bounds(self, geometry):
+        raise NotImplementedError
+
+    def grow_trees(self, count, data, bands, seed=0):
+        raise NotImplementedError
+
+    def ensemble(self, trees):
+        raise NotImplementedError
+
+    def error_matrix(self, model, data, bands):
+        raise NotImplementedError
+
+    def export_model(self, model):
+        raise NotImplementedError
+
+    def import_model(self, payload):
+        raise NotImplementedError
+
+    def feature_importance(self, model, bands):
+        raise NotImplementedError
+
+    def county_names(self):
+        raise NotImplementedError
+
+    def county_geometry(self, name):
+        raise NotImplementedError
+
+    def county_centroid(self, name):
+        raise NotImplementedError
+
+
+class EEBackend(Backend):
+    name = 'ee'
+
+    def counties(self):
+        return ee.FeatureCollection('TIGER/2018/Counties').filter(ee.Filter.eq('STATEFP', '06'))
+
+    def rectangle(self, bounds):
+        return ee.Geometry.Rectangle(list(bounds))
+
+    def rectangles(self, bounds_list):
+        # One MultiPolygon so composites and clips only cover the listed boxes
+        return ee.Geometry.MultiPolygon([[rectangle_ring(bounds)] for bounds in bounds_list], None, False)
+
+    def points(self, df):
+        return fnc.get_points_fc(df)
+
+    def feature_collection(self, features):
+        return ee.FeatureCollection(features)
+
+    def merge(self, collections):
+        return ee.FeatureCollection(list(collections)).flatten()
+
+    def composite(self, collection_id, roi, start, end, cloud=20, method='median', percentile=50, bands=None):
+        return fnc.get_composite(collection_id, roi, start, end, cloud, bands, method=method, percentile=percentile)
+
+    def sample_regions(self, image, collection, bands=None, properties=('class',), scale=30):
+        if bands:
+            image = image.select(bands)
+        return image.sampleRegions(collection=collection, properties=list(properties), scale=scale, geometries=True)
+
+    def size(self, collection):
+        return fnc.get_info(collection.size(), what='size')
+
+    def train_rf(self, numtrees, data, bands):
+        return ee.Classifier.smileRandomForest(numtrees).train(data, 'class', bands)
+
+    def classify(self, image, model, bands):
+        return image.select(bands).classify(model)
+
+    def classify_tile(self, image, model, bands, bounds, shape, step):
+        # Pull one window of the classification back as a NumPy array
+        xmin, ymin, xmax, ymax = bounds
+        height, width = shape
+        classified = self.classify(image, model, bands).unmask(-1).toInt16()
+        with fnc.span('computePixels', width=width, height=height):
+            pixels = ee.data.computePixels({
+                'expression': classified,
+                'fileFormat': 'NUMPY_NDARRAY',
+                'grid': {
+                    'dimensions': {'width': width, 'height': height},
+                    'affineTransform': {
+                        'scaleX': step, 'shearX': 0, 'translateX': xmin,
+                        'shearY': 0, 'scaleY': -step, 'translateY': ymax,
+                    },
+                    'crsCode': 'EPSG:4326',
+                },
+            })
+        values = pixels['classification'].astype(np.float32)
+        values[values < 0] = np.nan
+        return values
+
+    def bounds(self, geometry):
+        ring = np.asarray(fnc.get_info(ee.Geometry(geometry).bounds().coordinates(), what='bounds')[0])
+        return (ring[:, 0].min(), ring[:, 1].min(), ring[:, 0].max(), ring[:, 1].max())
+
+    def grow_trees(self, count, data, bands, seed=0):
+        # Train only the requested trees and bring their definitions back
+        model = ee.Classifier.smileRandomForest(numberOfTrees=count, seed=seed).train(data, 'class', bands)
+        return fnc.get_info(ee.Dictionary(model.explain()).get('trees'), what='trees', count=count)
+
+    def ensemble(self, trees):
+        return ee.Classifier.decisionTreeEnsemble(list(trees))
+
+    def error_matrix(self, model, data, bands):
+        return data.classify(model).errorMatrix('class', 'classification')
+
+    def export_model(self, model):
+        # Trees, input bands and training metrics come back in one round trip.
+        # The bands let the local backend run the same trees (see import_model).
+        matrix = model.confusionMatrix()
+        info = fnc.get_info(ee.Dictionary({
+            'trees': model.explain().get('trees'),
+            'bands': model.schema(),
+            'matrix': matrix.array(),
+            'accuracy': matrix.accuracy(),
+            'importance': fnc.ee_importance(model),
+        }), what='model export')
+        metrics = {'matrix': info['matrix'], 'accuracy': info['accuracy'], 'importance': info['importance']}
+        return {'trees': info['trees'], 'bands': info['bands']}, metrics
+
+    def import_model(self, payload):
+        return ee.Classifier.decisionTreeEnsemble(payload['trees'])
+
+    def feature_importance(self, model, bands):
+        return fnc.get_info(fnc.ee_importance(model), what='importance')
+
+    def county_names(self):
+        return ca_counties.county_names()
+
+    def county_geometry(self, name):
+        return self.counties().filter(ee.Filter.eq('NAME', name)).geometry()
+
+    def county_centroid(self, name):
+        return ca_counties.county_centroid(name)
+
+
+class LocalImage:
+    # Float32 band stack on a regular lon/lat grid; NaN marks masked pixels.
+    # transform is (x0, dx, y0, dy) for the upper-left corner, dy is negative.
+    def __init__(self, data, names, transform):
+        self.data = data
+        self.names = list(names)
+        self.transform = tuple(transform)
+
+    @property
+    def shape(self):
+        return self.data.shape[1:]
+
+    def select(self, bands):
+        return LocalImage(self.data[[self.names.index(band) for band in bands]], bands, self.transform)
+
+    def bounds(self):
+        x0, dx, y0, dy = self.transform
+        height, width = self.shape
+        return (x0, y0 + height * dy, x0 + width * dx, y0)
+
+    def pixel_centers(self):
+        x0, dx, y0, dy = self.transform
+        height, width = self.shape
+        return x0 + (np.arange(width) + 0.5) * dx, y0 + (np.arange(height) + 0.5) * dy
+
+
+def rectangle_ring(bounds):
+    xmin, ymin, xmax, ymax = [float(v) for v in bounds]
+    return [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]
+
+
+def geometry_rings(geometry):
+    # Outer and inner rings of a GeoJSON (Multi)Polygon
+    if geometry['type'] == 'Polygon':
+        return [ring for ring in geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return [ring for polygon in geometry['coordinates'] for ring in polygon]
+    raise ValueError(f"Unsupported geometry type: {geometry['type']}")
+
+
+def geometry_bounds(geometry):
+    coords = np.concatenate([np.asarray(ring, dtype=np.float64) for ring in geometry_rings(geometry)])
+    return (coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max())
+
+
+def points_in_geometry(lon, lat, geometry):
+    # Even-odd ray casting within each polygon, vectorized over the points;
+    # the polygons of a MultiPolygon are combined as a union
+    if geometry['type'] == 'MultiPolygon':
+        inside = np.zeros(np.broadcast(lon, lat).shape, dtype=bool)
+        for polygon in geometry['coordinates']:
+            inside |= points_in_geometry(lon, lat, {'type': 'Polygon', 'coordinates': polygon})
+        return inside
+
+    inside = np.zeros(np.broadcast(lon, lat).shape, dtype=bool)
+    for ring in geometry_rings(geometry):
+        ring = np.asarray(ring, dtype=np.float64)
+        x1, y1 = ring[:-1, 0], ring[:-1, 1]
+        x2, y2 = ring[1:, 0], ring[1:, 1]
+        for ax, ay, bx, by in zip(x1, y1, x2, y2):
+            if ay == by:
+                continue
+            crosses = (ay > lat) != (by > lat)
+            x_cross = ax + (lat - ay) * (bx - ax) / (by - ay)
+            inside ^= crosses & (lon < x_cross)
+    return inside
+
+
+def collection_features(collection):
+    if isinstance(collection, dict) and collection.get('type') == 'FeatureCollection':
+        return collection['features']
+    return list(collection)
+
+
+def roi_geometry(roi):
+    # A FeatureCollection ROI becomes one MultiPolygon of its features
+    if isinstance(roi, dict) and roi.get('type') == 'FeatureCollection':
+        return {'type': 'MultiPolygon', 'coordinates': [
+            polygon for feature in roi['features']
+            for polygon in (feature['geometry']['coordinates'] if feature['geometry']['type'] == 'MultiPolygon'
+                            else [feature['geometry']['coordinates']])
+        ]}
+    return roi
+
+
+def scene_header(path):
+    # Date, cloud cover, grid and bands of a scene without reading its pixels
+    if path.endswith('.npz'):
+        with np.load(path) as scene, zipfile.ZipFile(path) as archive, archive.open('data.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(f)
+            return {
+                'path': path,
+                'bands': [str(band) for band in scene['bands']],
+                'shape': tuple(shape[1:]),
+                'transform': tuple(float(v) for v in scene['transform']),
+                'date': str(scene['date']),
+                'cloudy': float(scene['cloudy']),
+            }
+
+    import rasterio
+    with rasterio.open(path) as src:
+        tags = src.tags()
+        a = src.transform
+        return {
+            'path': path,
+            'bands': list(src.descriptions),
+            'shape': (src.height, src.width),
+            'transform': (a.c, a.a, a.f, a.e),
+            'date': tags['DATE'],
+            'cloudy': float(tags.get('CLOUDY_PIXEL_PERCENTAGE', 0)),
+        }
+
+
+def read_scene(path):
+    # .npz stacks hold data/bands/transform/date/cloudy; GeoTIFFs need rasterio
+    if path.endswith('.npz'):
+        with np.load(path) as scene:
+            return {
+                'data': scene['data'],
+                'bands': [str(band) for band in scene['bands']],
+                'transform': tuple(float(v) for v in scene['transform']),
+                'date': str(scene['date']),
+                'cloudy': float(scene['cloudy']),
+            }
+
+    import rasterio
+    with rasterio.open(path) as src:
+        tags = src.tags()
+        a = src.transform
+        return {
+            'data': src.read(),
+            'bands': list(src.descriptions),
+            'transform': (a.c, a.a, a.f, a.e),
+            'date': tags['DATE'],
+            'cloudy': float(tags.get('CLOUDY_PIXEL_PERCENTAGE', 0)),
+        }
+
+
+class LocalBackend(Backend):
+    name = 'local'
+    imports_from = ('ee',)
+
+    def __init__(self, root, store=None):
+        self.root = root
+        # Scenes are read through the chunked band store unless TNC_STORE_MAX_MB=0
+        if store is None and STORE_MAX_BYTES > 0:
+            store = BandStore(os.path.join(fnc.CACHE_DIR, 'bands'))
+        self.store = store
+
+    def scenes(self, collection_id):
+        # .npz and .tif stacks under <root>/<collection id>/, listed on every
+        # call (one directory read) so added or removed scenes are picked up
+        folder = os.path.join(self.root, *collection_id.split('/'))
+        return sorted(glob.glob(os.path.join(folder, '*.npz')) + glob.glob(os.path.join(folder, '*.tif')))
+
+    def rectangle(self, bounds):
+        return {'type': 'Polygon', 'coordinates': [rectangle_ring(bounds)]}
+
+    def rectangles(self, bounds_list):
+        return {'type': 'MultiPolygon', 'coordinates': [[rectangle_ring(bounds)] for bounds in bounds_list]}
+
+    def points(self, df):
+        return fnc.points_geojson(df)
+
+    def feature_collection(self, features):
+        return {'type': 'FeatureCollection', 'features': list(features)}
+
+    def merge(self, collections):
+        collections = list(collections)
+        if collections and isinstance(collections[0], pd.DataFrame):
+            return pd.concat(collections, ignore_index=True)
+        features = [feature for collection in collections for feature in collection_features(collection)]
+        return self.feature_collection(features)
+
+    def select_scenes(self, collection_id, roi, start, end, cloud=20):
+        # Headers of the scenes in [start, end) under the cloud limit that touch the ROI
+        bounds = geometry_bounds(roi)
+        start, end = dt.strptime(str(start), "%Y-%m-%d"), dt.strptime(str(end), "%Y-%m-%d")
+        window = (f"{start:%Y-%m-%d}", f"{end:%Y-%m-%d}", cloud, bounds)
+        if self.store is not None:
+            selected = self.store.query(collection_id, self.scenes(collection_id), scene_header, *window)
+        else:
+            headers = sorted(map(scene_header, self.scenes(collection_id)), key=lambda header: header['date'])
+            selected = filter_headers(headers, [header['date'] for header in headers], *window)
+
+        if not selected:
+            raise ValueError(f"No scenes in {collection_id} between {start:%Y-%m-%d} and {end:%Y-%m-%d}")
+        grid = (selected[0]['transform'], selected[0]['shape'])
+        for header in selected:
+            if (header['transform'], header['shape']) != grid:
+                raise ValueError(f"Scene {header['path']} is not on the same grid as the rest of {collection_id}")
+        return selected
+
+    def roi_window(self, header, roi):
+        # Pixel window of the scene grid around the ROI, plus one window per
+        # polygon of a MultiPolygon so that reads can skip the chunks between them
+        window = bounds_window(header, geometry_bounds(roi))
+        if window is None:
+            raise ValueError("The ROI does not overlap the scene grid")
+        parts = None
+        if roi['type'] == 'MultiPolygon':
+            parts = [bounds_window(header, geometry_bounds({'type': 'Polygon', 'coordinates': polygon}))
+                     for polygon in roi['coordinates']]
+            parts = [part for part in parts if part is not None]
+        return window, parts
+
+    def scene_stack(self, header, window=None, parts=None, features=None, cloud_score=False):
+        # Requested features of one scene (every reflectance and index by
+        # default; NaN where masked) over a pixel window (the whole scene by
+        # default), plus its cloud score when asked for. Only the raw bands those
+        # features need are read and only the needed indices are computed.
+        features = list(features or indices.REFLECTANCE_BANDS + indices.INDEX_NAMES)
+        raw, _ = fnc.feature_plan(features)
+        needed = [band for band in raw + ['QA60'] + (['MSK_CLDPRB'] if cloud_score else []) if band in header['bands']]
+        if self.store is not None:
+            bands = self.store.read(header, needed, window, parts, load=read_scene)
+        else:
+            scene = read_scene(header['path'])
+            row0, row1, col0, col1 = window or (0, header['shape'][0], 0, header['shape'][1])
+            bands = {name: data[row0:row1, col0:col1] for name, data in zip(scene['bands'], scene['data']) if name in needed}
+        stack, names = indices.compute_indices(bands, bands.get('QA60'), features=features)
+        score = None
+        if cloud_score:
+            # Per-pixel cloud probability when the scene has it, the scene's cloud cover otherwise
+            score = bands['MSK_CLDPRB'].astype(np.float32) if 'MSK_CLDPRB' in bands else np.float32(header['cloudy'])
+        return stack, names, score
+
+    def clip(self, image, roi):
+        lon, lat = image.pixel_centers()
+        inside = points_in_geometry(lon[None, :], lat[:, None], roi)
+        image.data[:, ~inside] = np.nan
+        return image
+
+    def composite(self, collection_id, roi, start, end, cloud=20, method='median', percentile=50, bands=None):
+        composites.check_method(method)
+        roi = roi_geometry(roi)
+        headers = self.select_scenes(collection_id, roi, start, end, cloud)
+
+        def build():
+            window, parts = self.roi_window(headers[0], roi)
+            stacks, scores = [], []
+            for header in headers:
+                stack, names, score = self.scene_stack(header, window, parts, bands, cloud_score=method == 'quality')
+                stacks.append(stack)
+                if score is not None:
+                    scores.append(np.broadcast_to(score, stack.shape[1:]))
+
+            data = composites.reduce_stack(np.stack(stacks), method, percentile, np.stack(scores) if scores else None)
+            image = self.clip(LocalImage(data, names, window_transform(headers[0], window)), roi)
+            # Shared by every caller from now on
+            image.data.setflags(write=False)
+            return image
+
+        # The scene files are part of the key, so replaced or edited scenes build a new composite
+        scenes = [(header['path'], os.stat(header['path']).st_mtime_ns) for header in headers]
+        key = fnc.composite_key(collection_id, roi, start, end, cloud, bands, method, percentile, scenes)
+        with fnc.span('composite', collection=collection_id, start=str(start), end=str(end), method=method) as record:
+            image, record['labels']['cached'] = fnc.composite_cache.get_or_create(key, build)
+        return image
+
+    def rolling_composite(self, collection_id, roi, cloud=20, bands=None, bins=64):
+        return LocalRollingComposite(self, collection_id, roi, cloud, bands, bins)
+
+    def sample_regions(self, image, collection, bands=None, properties=('class',), scale=30):
+        if bands:
+            image = image.select(bands)
+        x0, dx, y0, dy = image.transform
+        height, width = image.shape
+        rows, cols, props = [], [], []
+
+        for feature in collection_features(collection):
+            geometry = feature['geometry']
+            values = [feature['properties'].get(name) for name in properties]
+            if geometry['type'] in ('Point', 'MultiPoint'):
+                coords = np.asarray(geometry['coordinates'], dtype=np.float64).reshape(-1, 2)
+                col = np.floor((coords[:, 0] - x0) / dx).astype(np.int64)
+                row = np.floor((coords[:, 1] - y0) / dy).astype(np.int64)
+            else:
+                lon, lat = image.pixel_centers()
+                inside = points_in_geometry(lon[None, :], lat[:, None], geometry)
+                row, col = np.nonzero(inside)
+            keep = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+            rows.append(row[keep])
+            cols.append(col[keep])
+            props.extend([values] * int(keep.sum()))
+
+        # No features (or none on the grid) gives an empty table with the same columns
+        empty = np.zeros(0, dtype=np.int64)
+        row, col = np.concatenate(rows + [empty]), np.concatenate(cols + [empty])
+        table = pd.DataFrame(image.data[:, row, col].T, columns=image.names)
+        for i, name in enumerate(properties):
+            table[name] = [value[i] for value in props]
+        table['longitude'] = x0 + (col + 0.5) * dx
+        table['latitude'] = y0 + (row + 0.5) * dy
+
+        # Masked pixels are dropped, as sampleRegions does
+        return table.dropna(subset=image.names).reset_index(drop=True)
+
+    def size(self, collection):
+        if isinstance(collection, pd.DataFrame):
+            return len(collection)
+        return len(collection_features(collection))
+
+    def train_rf(self, numtrees, data, bands):
+        model = RandomForest(numtrees)
+        return model.fit(data[bands].to_numpy(), data['class'].to_numpy())
+
+    def classify(self, image, model, bands):
+        image = image.select(bands)
+        pixels = image.data.reshape(len(bands), -1).T
+        valid = ~np.isnan(pixels).any(axis=1)
+        classified = np.full(len(pixels), np.nan, dtype=np.float32)
+        classified[valid] = model.predict(pixels[valid])
+        return LocalImage(classified.reshape((1,) + image.shape), ['classification'], image.transform)
+
+    def grow_trees(self, count, data, bands, seed=0):
+        model = RandomForest(count, seed=seed)
+        return model.fit(data[bands].to_numpy(), data['class'].to_numpy()).trees
+
+    def ensemble(self, trees):
+        n_classes = max(label for tree in trees for label in forest_labels(tree)) + 1
+        return RandomForest.from_trees(trees, n_classes)
+
+    def error_matrix(self, model, data, bands):
+        actual = data['class'].to_numpy().astype(np.int64)
+        predicted = model.predict(data[bands].to_numpy())
+        size = max(model.n_classes, int(actual.max()) + 1)
+        matrix = np.zeros((size, size), dtype=np.int64)
+        np.add.at(matrix, (actual, predicted), 1)
+        return matrix
+
+    def export_model(self, model):
+        return model.to_dict(), {}
+
+    def classify_tile(self, image, model, bands, bounds, shape, step):
+        # Nearest-neighbour lookup of the requested window on the image grid
+        xmin, ymin, xmax, ymax = bounds
+        height, width = shape
+        x0, dx, y0, dy = image.transform
+        image = image.select(bands)
+        cols = np.floor((xmin + (np.arange(width) + 0.5) * step - x0) / dx).astype(np.int64)
+        rows = np.floor((ymax - (np.arange(height) + 0.5) * step - y0) / dy).astype(np.int64)
+        rows, cols = np.meshgrid(rows, cols, indexing='ij')
+        inside = (rows >= 0) & (rows < image.shape[0]) & (cols >= 0) & (cols < image.shape[1])
+
+        window = np.full((len(bands), height, width), np.nan, dtype=np.float32)
+        window[:, inside] = image.data[:, rows[inside], cols[inside]]
+        pixels = window.reshape(len(bands), -1).T
+        valid = ~np.isnan(pixels).any(axis=1)
+        values = np.full(len(pixels), np.nan, dtype=np.float32)
+        if valid.any():
+            # Tiles already run in parallel, so each one predicts on a single thread
+            values[valid] = model.predict(pixels[valid], workers=1)
+        return values.reshape(height, width)
+
+    def bounds(self, geometry):
+        if isinstance(geometry, LocalImage):
+            return geometry.bounds()
+        return geometry_bounds(geometry)
+
+    def import_model(self, payload):
+        # Local artifacts, or the tree strings of an Earth Engine one
+        if 'numtrees' not in payload:
+            return forest_from_ee(payload['trees'], payload['bands'])
+        return RandomForest.from_dict(payload)
+
+    def feature_importance(self, model, bands):
+        return dict(zip(bands, model.importances(len(bands))))
+
+    def county_names(self):
+        return ca_counties.county_names()
+
+    def county_geometry(self, name):
+        # The bundled outlines are too coarse to clip a classification with
+        return ca_counties.county_roi(name)
+
+    def county_centroid(self, name):
+        return ca_counties.county_centroid(name)
+
+
+class LocalRollingComposite:
+    # Rolling composite over one collection and ROI for the local backend.
+    # Each window() call only loads the scenes that entered or left the window.
+    # Short windows keep their scenes and are reduced exactly (RollingStack);
+    # once that would cost more memory than the histogram sketch, the window
+    # switches to a RollingComposite (rebuilt from the window's scenes).
+    #   rolling = backend.rolling_composite('COPERNICUS/S2_SR_HARMONIZED', roi)
+    #   for start, end in windows:
+    #       image = rolling.window(start, end, 'median')
+    def __init__(self, backend, collection_id, roi, cloud=20, bands=None, bins=64):
+        self.backend = backend
+        self.collection_id = collection_id
+        self.roi = roi_geometry(roi)
+        self.cloud = cloud
+        self.bands = list(bands) if bands else indices.REFLECTANCE_BANDS + indices.INDEX_NAMES
+        self.bins = bins
+        self.rolling = None
+        self.transform = None
+        self.headers = {}
+
+    def load(self, path):
+        stack, _, _ = self.backend.scene_stack(self.headers[path], self.pixels, self.parts, self.bands)
+        return stack
+
+    def window(self, start, end, method='median', percentile=50):
+        headers = self.backend.select_scenes(self.collection_id, self.roi, start, end, self.cloud)
+        self.headers.update((header['path'], header) for header in headers)
+        if self.transform is None:
+            self.pixels, self.parts = self.backend.roi_window(headers[0], self.roi)
+            self.transform = window_transform(headers[0], self.pixels)
+        row0, row1, col0, col1 = self.pixels
+        shape = (row1 - row0, col1 - col0)
+
+        exact = composites.stack_bytes(len(self.bands), len(headers)) <= composites.sketch_bytes(len(self.bands), self.bins)
+        if exact and not isinstance(self.rolling, composites.RollingStack):
+            self.rolling = composites.RollingStack(self.load, self.bands, shape)
+        elif not exact and not isinstance(self.rolling, composites.RollingComposite):
+            self.rolling = composites.RollingComposite(self.load, self.bands, shape, self.bins)
+        with fnc.span('rolling composite', start=str(start), end=str(end)) as record:
+            added, removed = self.rolling.update(header['path'] for header in headers)
+            record['labels'].update({'added': len(added), 'removed': len(removed), 'exact': exact})
+            image = LocalImage(self.rolling.result(method, percentile), self.bands, self.transform)
+        return self.backend.clip(image, self.roi)
+
+
+_backends = {}
+
+
+def get_backend(name=None, root=None):
+    # One backend instance per (name, root) for the whole process
+    name = name or os.environ.get('TNC_BACKEND', 'ee')
+    root = root or os.environ.get('TNC_LOCAL_DATA', 'local_data')
+    key = (name, root if name == 'local' else None)
+    if key not in _backends:
+        if name == 'ee':
+            _backends[key] = EEBackend()
+        elif name == 'local':
+            _backends[key] = LocalBackend(root)
+        else:
+            raise ValueError(f"Unknown backend: {name}")
+    return _backends[key]
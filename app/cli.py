@@ -0,0 +1,311 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import importlib.util
+from datetime import datetime as dt
+
+import numpy as np
+
+import app.fnc as fnc
+import app.counties as ca_counties
+from app.backend import get_backend
+from app.concurrency import map_bounded
+from app.tiling import classify_tiled
+
+# Headless batch classification over a county x date-window matrix.
+#   python -m app.cli --counties "Ventura,Santa Barbara" --windows 2020-01-01:2020-01-15 2020-06-01:2020-06-15
+#   python -m app.cli --all-counties --windows 2020-01-01:2020-01-15 --out maps/2020
+# The model is trained (or loaded from models/) once with the same data and
+# settings as the pretrained page. Every finished job is recorded in
+# <out>/manifest.json, so rerunning the same command skips what is done.
+
+MANIFEST_VERSION = 1
+NODATA = 255
+
+# Same training setup as the pretrained page
+BANDS = fnc.DEFAULT_BANDS
+CLASS_MAPPING = {'hoop': 0, 'mulch': 1, 'other': 2, 'green house': 3}
+DATA_PATH = 'data'
+CSV_FILENAMES = ['Mendocino', 'SantaMaria', 'Watsonville']
+SHAPE_FILENAMES = [['Oxnard', 'label_mulch_hoop', 'label_nonplastic']]
+SHAPE_DATES = [['2019-02-01', '2019-06-01']]
+NUMTREES = 50
+
+
+def parse_window(text):
+    # YYYY-MM-DD:YYYY-MM-DD
+    try:
+        start, end = text.split(':')
+        dt.strptime(start, "%Y-%m-%d")
+        dt.strptime(end, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected START:END dates like 2020-01-01:2020-01-15, got '{text}'")
+    if start >= end:
+        raise argparse.ArgumentTypeError(f"Window '{text}' ends before it starts")
+    return start, end
+
+
+def job_id(county, start, end):
+    return f"{re.sub(r'[^a-z0-9]+', '-', county.lower()).strip('-')}_{start}_{end}"
+
+
+def parse_bands(text):
+    # Comma-separated model features (raw bands and indices)
+    bands = [name.strip() for name in text.split(',') if name.strip()]
+    try:
+        fnc.feature_plan(bands)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if not bands:
+        raise argparse.ArgumentTypeError("Expected at least one band")
+    return bands
+
+
+def train_model(backend, data_path, csv_filenames, shape_filenames, dates, numtrees, bands=BANDS):
+    # Train once, or load the artifact the pages and earlier runs saved for the same inputs
+    key = fnc.pretrained_key(data_path, bands, CLASS_MAPPING, csv_filenames=csv_filenames,
+                             shape_filenames=shape_filenames, dates=dates, numtrees=numtrees)
+
+    def train():
+        with fnc.span('ingestion', files=len(csv_filenames) + sum(len(group) for group in shape_filenames)):
+            csv_data, shape_data = fnc.load_data(data_path, csv_filenames, shape_filenames, backend)
+        # load_data skips files it cannot parse
+        if not csv_data and not any(shape_data):
+            raise SystemExit(f"No training labels could be read from {os.path.abspath(data_path)}")
+        fcs = fnc.create_fc_csv(csv_data, csv_filenames, CLASS_MAPPING, bands, backend)
+        fcs += fnc.create_fc_shape(shape_data, dates, backend, bands=bands)
+        sources = csv_filenames + [group[0] for group in shape_filenames]
+        counts = fnc.get_sample_counts(dict(zip(sources, fcs)), backend)
+        print(f"SAMPLES: {', '.join(f'{name} {count}' for name, count in counts.items())}")
+        return backend.train_rf(numtrees, backend.merge(fcs), bands)
+
+    model, metrics = fnc.get_pretrained_model(key, train, backend)
+    return key, model, metrics
+
+
+class Manifest:
+    # Job states in a JSON file, rewritten atomically after every change
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, config, force=False):
+        manifest = cls(path, config)
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('version') != MANIFEST_VERSION or saved.get('config') != config:
+                if not force:
+                    raise SystemExit(f"{path} was written for different settings; use another --out or pass --force")
+            else:
+                manifest.jobs = saved['jobs']
+        return manifest
+
+    def add(self, job):
+        with self._lock:
+            self.jobs.setdefault(job['id'], {**job, 'status': 'pending'})
+
+    def update(self, id, **fields):
+        with self._lock:
+            self.jobs[id].update(fields)
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'config': self.config, 'jobs': self.jobs}, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    def pending(self):
+        # Anything not finished (including jobs that were running when a run stopped)
+        with self._lock:
+            return [job for job in self.jobs.values()
+                    if job['status'] != 'done' or not os.path.exists(job.get('path') or '')]
+
+
+def check_format(fmt):
+    # Fail before any job runs rather than writing something other than what was asked for
+    if fmt == 'cog' and importlib.util.find_spec('rasterio') is None:
+        raise SystemExit("Writing GeoTIFFs needs rasterio (pip install rasterio); pass --format npz to write .npz arrays instead")
+
+
+def check_labels(data_path, csv_filenames, shape_filenames):
+    # --data defaults to a folder relative to the working directory, so name the
+    # folder that was searched when label files are missing
+    files = [f'{name}.csv' for name in csv_filenames] + [f'{name}.shp' for group in shape_filenames for name in group]
+    if not files:
+        raise SystemExit("No training labels given; pass --csv and/or --shapes")
+    missing = [name for name in files if not os.path.exists(os.path.join(data_path, name))]
+    if missing:
+        raise SystemExit(f"Training labels not found in {os.path.abspath(data_path)}: {', '.join(missing)} "
+                         f"(pass --data with the folder that holds them)")
+
+
+def write_raster(path, mosaic, grid, county, start, end, fmt='cog'):
+    # Class raster (uint8, 255 = no data) as a Cloud-Optimized GeoTIFF, or with
+    # fmt='npz' the array and its transform in a compressed .npz
+    data = np.where(np.isnan(mosaic), NODATA, mosaic).astype(np.uint8)
+    x0, dx, y0, dy = grid.transform
+    tags = {'COUNTY': county, 'START': start, 'END': end, 'CLASSES': json.dumps(CLASS_MAPPING)}
+    if fmt == 'npz':
+        path = os.path.splitext(path)[0] + '.npz'
+        np.savez_compressed(path + '.tmp.npz', data=data, transform=np.array(grid.transform), nodata=NODATA, **tags)
+        os.replace(path + '.tmp.npz', path)
+        return path
+
+    import rasterio
+    from rasterio.transform import Affine
+
+    profile = {
+        'driver': 'COG', 'dtype': 'uint8', 'count': 1, 'nodata': NODATA,
+        'width': data.shape[1], 'height': data.shape[0], 'crs': 'EPSG:4326',
+        'transform': Affine(dx, 0, x0, 0, dy, y0),
+        'compress': 'DEFLATE', 'blocksize': 512, 'overview_resampling': 'nearest',
+    }
+    with rasterio.open(path + '.tmp', 'w', **profile) as dst:
+        dst.write(data, 1)
+        dst.update_tags(**tags)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def run_job(job, backend, model, manifest, args):
+    county, start, end = job['county'], job['start'], job['end']
+    manifest.update(job['id'], status='running', started=dt.now().isoformat(timespec='seconds'))
+    began = time.perf_counter()
+    with fnc.span('job', county=county, start=start, end=end):
+        roi = backend.county_geometry(county)
+        image = backend.composite(args.collection, roi, start, end, method=args.composite, percentile=args.percentile,
+                                  bands=args.bands)
+        mosaic, grid, failed = classify_tiled(
+            backend, image, model, args.bands, roi, scale=args.scale, tile_pixels=args.tile_pixels,
+            max_workers=args.tile_workers, retries=args.retries,
+        )
+        path = write_raster(os.path.join(args.out, f"{job['id']}.tif"), mosaic, grid, county, start, end, args.format)
+
+    fields = {
+        'path': path,
+        'shape': list(mosaic.shape),
+        'seconds': round(time.perf_counter() - began, 3),
+        'finished': dt.now().isoformat(timespec='seconds'),
+        'failed_tiles': [list(tile) for tile, _ in failed],
+    }
+    if failed:
+        # Keep the partial output but retry the job on the next run
+        fields.update(status='failed', error=f"{len(failed)} tiles failed: {failed[0][1]}")
+    else:
+        fields.update(status='done', error=None)
+    manifest.update(job['id'], **fields)
+    return fields['status']
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m app.cli', description="Classify agricultural plastics for counties x date windows.")
+    counties = parser.add_mutually_exclusive_group(required=True)
+    counties.add_argument('--counties', help="Comma-separated county names")
+    counties.add_argument('--all-counties', action='store_true', help="All 58 California counties")
+    parser.add_argument('--windows', nargs='+', type=parse_window, required=True, help="Date windows as START:END")
+    parser.add_argument('--out', default='outputs', help="Output folder (also holds manifest.json)")
+    parser.add_argument('--format', choices=['cog', 'npz'], default='cog',
+                        help="Cloud-Optimized GeoTIFF (needs rasterio) or compressed NumPy arrays")
+    parser.add_argument('--backend', choices=['ee', 'local'], default=os.environ.get('TNC_BACKEND', 'ee'))
+    parser.add_argument('--local-data', default=os.environ.get('TNC_LOCAL_DATA', 'local_data'), help="Scene folder for the local backend")
+    parser.add_argument('--key-file', help="Service account JSON key (default: Streamlit secrets)")
+    parser.add_argument('--collection', default='COPERNICUS/S2_SR', help="Image collection to composite")
+    parser.add_argument('--composite', choices=fnc.COMPOSITE_METHODS, default='median', help="How scenes in a window are combined")
+    parser.add_argument('--percentile', type=int, default=50, help="Percentile for --composite percentile")
+    parser.add_argument('--data', default=DATA_PATH, help="Training data folder")
+    parser.add_argument('--csv', default=','.join(CSV_FILENAMES), help="Training CSV names (without .csv)")
+    parser.add_argument('--shapes', default=';'.join(','.join(group) for group in SHAPE_FILENAMES),
+                        help="Shapefile groups: ';' between groups, ',' within (roi first); empty for none")
+    parser.add_argument('--numtrees', type=int, default=NUMTREES)
+    parser.add_argument('--bands', type=parse_bands, default=list(BANDS),
+                        help="Comma-separated model features, e.g. a reduced set picked from the IMPORTANCE line")
+    parser.add_argument('--scale', type=int, default=30, help="Output pixel size in metres")
+    parser.add_argument('--jobs', type=int, default=2, help="Jobs classified at the same time")
+    parser.add_argument('--tile-workers', type=int, default=4, help="Tile threads per job (requests from all jobs share TNC_MAX_CONCURRENCY)")
+    parser.add_argument('--tile-pixels', type=int, default=512)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--force', action='store_true', help="Start a new manifest even if settings changed")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    check_format(args.format)
+    timer = fnc.start_timer('cli')
+
+    if args.all_counties:
+        counties = ca_counties.county_names()
+    else:
+        counties = [name.strip() for name in args.counties.split(',') if name.strip()]
+        unknown = [name for name in counties if name not in ca_counties.load_index()]
+        if unknown:
+            raise SystemExit(f"Unknown counties: {', '.join(unknown)}")
+
+    csv_filenames = [name for name in args.csv.split(',') if name]
+    shape_filenames = [group.split(',') for group in args.shapes.split(';') if group]
+    shape_dates = SHAPE_DATES[:len(shape_filenames)]
+    check_labels(args.data, csv_filenames, shape_filenames)
+
+    if args.backend == 'ee':
+        import app.session as ee_session
+        secrets = None
+        if args.key_file:
+            with open(args.key_file) as f:
+                key_data = f.read()
+            secrets = {'data-service-account': key_data, 'service_account': json.loads(key_data)['client_email']}
+        ee_session.initialize(secrets)
+    backend = get_backend(args.backend, args.local_data)
+
+    with fnc.span('model'):
+        key, model, metrics = train_model(backend, args.data, csv_filenames, shape_filenames, shape_dates, args.numtrees,
+                                          args.bands)
+        # Exported with the model on Earth Engine; local forests compute it from their trees
+        importance = fnc.rank_importance(metrics.get('importance'), args.bands) or fnc.feature_importance(model, args.bands, backend)
+    print(f"MODEL: {key[:16]} (training accuracy {metrics.get('accuracy', 'n/a')})")
+    print(f"IMPORTANCE: {fnc.format_importance(importance)}")
+
+    config = {'model': key, 'backend': args.backend, 'collection': args.collection, 'scale': args.scale,
+              'composite': args.composite, 'percentile': args.percentile, 'format': args.format}
+    manifest = Manifest.load(os.path.join(args.out, 'manifest.json'), config, args.force)
+    for county in counties:
+        for start, end in args.windows:
+            manifest.add({'id': job_id(county, start, end), 'county': county, 'start': start, 'end': end})
+    manifest.save()
+
+    jobs = manifest.pending()
+    print(f"JOBS: {len(jobs)} to run, {len(manifest.jobs) - len(jobs)} already done")
+
+    def run(job):
+        try:
+            status = run_job(job, backend, model, manifest, args)
+        except Exception as e:
+            manifest.update(job['id'], status='failed', error=f"{type(e).__name__}: {e}")
+            status = 'failed'
+        print(f"JOB: {job['id']} {status}")
+        return status
+
+    statuses = map_bounded(run, jobs, max_workers=args.jobs, retries=0)
+    fnc.export_metrics(timer)
+
+    failed = statuses.count('failed')
+    print(f"DONE: {statuses.count('done')} finished, {failed} failed; manifest at {manifest.path}")
+    for total in timer.summary()[:8]:
+        print(f"TIME: {total['seconds']:9.2f} s  {total['count']:4d}x  {total['name']}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
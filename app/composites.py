@@ -0,0 +1,250 @@
+import warnings
+
+import numpy as np
+
+# Local compositing strategies (the NumPy side of fnc.reduce_collection) and a
+# rolling composite that is updated scene by scene as its date window moves.
+#   median / mean / percentile   per-pixel statistic over the scenes
+#   quality                      per pixel, the scene with the lowest cloud score
+
+METHODS = ['median', 'mean', 'percentile', 'quality']
+
+# Value range each band's quantile sketch covers; values outside are clamped
+# to the first or last bin. Reflectances are DN / 10000.
+BAND_RANGES = {
+    'B2': (0.0, 1.0), 'B3': (0.0, 1.0), 'B4': (0.0, 1.0), 'B6': (0.0, 1.0),
+    'B8': (0.0, 1.0), 'B11': (0.0, 1.0), 'B12': (0.0, 1.0),
+    'NDVI': (-1.0, 1.0), 'NDTI': (-1.0, 1.0), 'PMLI': (-1.0, 1.0),
+    'PGI': (-50.0, 50.0), 'RPGI': (-150.0, 50.0),
+}
+
+
+def sketch_bytes(bands, bins):
+    # Per-pixel memory of a RollingComposite: uint8 histogram, float64 sums, uint16 counts
+    return bands * (bins + 8 + 2)
+
+
+def stack_bytes(bands, scenes):
+    # Per-pixel memory of a RollingStack holding `scenes` float32 scenes
+    return bands * 4 * scenes
+
+
+def check_method(method):
+    if method not in METHODS:
+        raise ValueError(f"Unknown composite method '{method}' (expected one of {', '.join(METHODS)})")
+
+
+def nan_quantile(stacks, q):
+    # np.nanquantile along the scene axis without its per-pixel Python loop:
+    # NaNs sort to the end, so each pixel's valid values lead its column
+    ordered = np.sort(stacks, axis=0)
+    count = (~np.isnan(stacks)).sum(axis=0)
+    rank = q * np.maximum(count - 1, 0)
+    low = np.floor(rank).astype(np.intp)
+    high = np.minimum(low + 1, np.maximum(count - 1, 0))
+    below = np.take_along_axis(ordered, low[None], axis=0)[0]
+    above = np.take_along_axis(ordered, high[None], axis=0)[0]
+    values = below + (rank - low) * (above - below)
+    return np.where(count > 0, values, np.nan).astype(np.float32)
+
+
+def reduce_stack(stacks, method='median', percentile=50, scores=None):
+    # stacks: (scenes, bands, H, W) float32 with NaN for masked pixels. scores:
+    # per-scene cloud scores, (scenes,) or (scenes, H, W), lower is better.
+    check_method(method)
+    stacks = np.asarray(stacks, dtype=np.float32)
+    with warnings.catch_warnings():
+        # Pixels masked in every scene stay NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'median':
+            return nan_quantile(stacks, 0.5)
+        if method == 'mean':
+            return np.nanmean(stacks, axis=0).astype(np.float32)
+        if method == 'percentile':
+            return nan_quantile(stacks, percentile / 100)
+
+    # Quality mosaic: best scored scene among those that are not masked
+    if scores is None:
+        scores = np.zeros(len(stacks), dtype=np.float32)
+    scores = np.asarray(scores, dtype=np.float32)
+    if scores.ndim == 1:
+        scores = np.broadcast_to(scores[:, None, None], (len(stacks),) + stacks.shape[2:])
+    scores = np.where(np.isnan(stacks).any(axis=1), np.inf, scores)
+    best = np.argmin(scores, axis=0)
+    composite = np.take_along_axis(stacks, best[None, None], axis=0)[0]
+    composite[:, np.isinf(scores.min(axis=0))] = np.nan
+    return composite
+
+
+class RollingWindow:
+    # Scene bookkeeping shared by the rolling composites; subclasses add and
+    # remove one scene's contribution and keep the keys in self.scenes
+    def update(self, keys):
+        # Move the window to exactly these scenes; returns (added, removed)
+        keys = set(keys)
+        removed = sorted(self.scenes - keys)
+        added = sorted(keys - self.scenes)
+        for key in removed:
+            self.remove(key)
+        for key in added:
+            self.add(key)
+        return added, removed
+
+
+class RollingStack(RollingWindow):
+    # Exact rolling composite: the scenes in the window are kept as they are
+    # and reduced with reduce_stack, a block of rows at a time so the reduction
+    # needs little memory beyond the scenes. It costs stack_bytes() per pixel,
+    # less than the sketch while the window holds fewer than (bins + 10) / 4
+    # scenes (18 at 64 bins).
+    def __init__(self, load, names, shape, block_rows=256):
+        self.load = load
+        self.names = list(names)
+        self.shape = tuple(shape)
+        self.block_rows = block_rows
+        self.stacks = {}
+        self.scenes = set()
+        self.loads = 0
+
+    def add(self, key):
+        if key not in self.scenes:
+            self.stacks[key] = self.load(key)
+            self.loads += 1
+            self.scenes.add(key)
+
+    def remove(self, key):
+        self.stacks.pop(key, None)
+        self.scenes.discard(key)
+
+    def result(self, method='median', percentile=50):
+        if method not in ('median', 'mean', 'percentile'):
+            raise ValueError(f"Rolling composites support median, mean and percentile, not '{method}'")
+        out = np.full((len(self.names),) + self.shape, np.nan, dtype=np.float32)
+        stacks = [self.stacks[key] for key in sorted(self.scenes)]
+        if stacks:
+            for row in range(0, self.shape[0], self.block_rows):
+                block = np.stack([stack[:, row:row + self.block_rows] for stack in stacks])
+                out[:, row:row + self.block_rows] = reduce_stack(block, method, percentile)
+        return out
+
+
+class RollingComposite(RollingWindow):
+    # Per-pixel running sums, counts and a fixed-bin histogram sketch per band.
+    # Moving the window only adds the scenes that entered it and subtracts the
+    # ones that left, so stepping through a time series reads each scene about
+    # twice instead of once per window it belongs to.
+    #   rolling = RollingComposite(load, names, shape)
+    #   rolling.update(['2020-01-03', '2020-01-08'])       # scene keys now in the window
+    #   rolling.result('median')
+    # load(key) returns the scene's (bands, H, W) float32 stack. Quantiles are
+    # read from the sketch, so they are exact to about one bin width
+    # ((hi - lo) / bins of the band's range). Memory is sketch_bytes() per
+    # pixel whatever the number of scenes: 888 B for all 12 bands at 64 bins.
+    def __init__(self, load, names, shape, bins=64, ranges=None):
+        if not 1 < bins < 256:
+            raise ValueError("RollingComposite needs between 2 and 255 bins")
+        self.load = load
+        self.names = list(names)
+        self.bins = bins
+        ranges = {**BAND_RANGES, **(ranges or {})}
+        self.lo = np.array([ranges[name][0] for name in self.names], dtype=np.float32)[:, None, None]
+        self.hi = np.array([ranges[name][1] for name in self.names], dtype=np.float32)[:, None, None]
+
+        bands = len(self.names)
+        self.sum = np.zeros((bands,) + tuple(shape), dtype=np.float64)
+        self.count = np.zeros((bands,) + tuple(shape), dtype=np.uint16)
+        self.hist = np.zeros((bands, bins, int(np.prod(shape))), dtype=np.uint8)
+        self.scenes = set()
+        self.loads = 0
+
+    def _apply(self, key, adding):
+        stack = self.load(key)
+        self.loads += 1
+        valid = ~np.isnan(stack)
+        values = np.where(valid, stack, 0)
+        codes = np.floor((values - self.lo) / (self.hi - self.lo) * self.bins)
+        codes = np.clip(codes, 0, self.bins - 1).astype(np.intp)
+        if adding:
+            self.sum += values
+            self.count += valid
+        else:
+            self.sum -= values
+            self.count -= valid
+
+        # Every pixel lands in exactly one bin per band, so a flat index into
+        # that band's (bins, H*W) histogram has no repeats
+        pixels = np.arange(codes[0].size)
+        for band in range(len(self.names)):
+            mask = valid[band].ravel()
+            cells = codes[band].ravel()[mask] * codes[0].size + pixels[mask]
+            hist = self.hist[band].reshape(-1)
+            if adding:
+                hist[cells] += 1
+            else:
+                hist[cells] -= 1
+
+    def add(self, key):
+        if key not in self.scenes:
+            if len(self.scenes) >= 255:
+                raise ValueError("RollingComposite holds at most 255 scenes per window")
+            self._apply(key, True)
+            self.scenes.add(key)
+
+    def remove(self, key):
+        if key in self.scenes:
+            self._apply(key, False)
+            self.scenes.discard(key)
+
+    def mean(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.sum / self.count
+        return np.where(self.count > 0, mean, np.nan).astype(np.float32)
+
+    def _values_at_ranks(self, hist, ranks):
+        # Values of the rank-th smallest samples (0-based) of one band, as a
+        # fraction of the band's range, spread evenly inside their bin. One pass
+        # over the bins with a running count serves every rank; it is much
+        # cheaper than materializing the (bins, H*W) cumulative histogram.
+        pixels = np.arange(hist.shape[1])
+        cumulative = np.zeros(hist.shape[1], dtype=np.uint16)
+        passed = np.empty(hist.shape[1], dtype=bool)
+        counted = np.empty(hist.shape[1], dtype=np.uint8)
+        # Branch-free updates: bins up to the rank's bin add their counts to `before`
+        bin_index = [np.zeros(hist.shape[1], dtype=np.uint8) for _ in ranks]
+        before = [np.zeros(hist.shape[1], dtype=np.uint16) for _ in ranks]
+        for counts in hist:
+            np.add(cumulative, counts, out=cumulative)
+            for rank, index, count in zip(ranks, bin_index, before):
+                np.less_equal(cumulative, rank, out=passed)
+                index += passed
+                np.multiply(counts, passed, out=counted)
+                count += counted
+
+        values = []
+        for rank, index, count in zip(ranks, bin_index, before):
+            index = np.minimum(index, self.bins - 1).astype(np.intp)
+            inside = np.maximum(hist[index, pixels], 1)
+            values.append((index + (rank - count + 0.5) / inside) / self.bins)
+        return values
+
+    def quantile(self, q):
+        # Same rank interpolation as np.nanquantile, with values read from the
+        # sketch one band at a time
+        values = np.empty(self.count.shape, dtype=np.float32)
+        for band in range(len(self.names)):
+            rank = q * np.maximum(self.count[band].ravel().astype(np.float32) - 1, 0)
+            low, high = np.floor(rank), np.ceil(rank)
+            # Integer ranks keep the comparisons in uint16
+            below, above = self._values_at_ranks(self.hist[band], [low.astype(np.uint16), high.astype(np.uint16)])
+            fraction = below + (rank - low) * (above - below)
+            values[band] = (self.lo[band] + fraction * (self.hi[band] - self.lo[band])).reshape(values.shape[1:])
+        return np.where(self.count > 0, values, np.nan).astype(np.float32)
+
+    def result(self, method='median', percentile=50):
+        if method == 'mean':
+            return self.mean()
+        if method == 'median':
+            return self.quantile(0.5)
+        if method == 'percentile':
+            return self.quantile(percentile / 100)
+        raise ValueError(f"Rolling composites support median, mean and percentile, not '{method}'")
@@ -0,0 +1,71 @@
+import os
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Bounded concurrency for Earth Engine work. Every blocking request (getInfo,
+# computePixels) runs through request(), under one process-wide cap
+# (TNC_MAX_CONCURRENCY, shared by all sessions) so parallel work stays within
+# the GEE request quota, and rate-limit errors are retried with exponential
+# backoff. map_bounded runs tasks in parallel with results in input order.
+
+MAX_CONCURRENCY = int(os.environ.get('TNC_MAX_CONCURRENCY', '4'))
+request_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
+# Substrings of the errors Earth Engine raises when a quota is hit
+RATE_LIMIT_MARKERS = ('too many', 'rate limit', 'quota', 'resource exhausted', '429')
+
+
+def is_rate_limited(error):
+    message = str(error).lower()
+    return any(marker in message for marker in RATE_LIMIT_MARKERS)
+
+
+def with_retries(fn, retries=3, backoff=1.0, retry_on=None, max_backoff=60.0):
+    # Call fn, retrying with exponential backoff (plus jitter) while retry_on(error)
+    # is true, or on any error if retry_on is None; the last error is re-raised
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries or (retry_on is not None and not retry_on(e)):
+                raise
+            delay = min(max_backoff, backoff * 2 ** attempt)
+            time.sleep(delay * (0.5 + random.random() / 2))
+
+
+def request(fn, retries=3, backoff=1.0):
+    # One blocking Earth Engine call. The slot is held per attempt, so a call
+    # sleeping in backoff does not keep other sessions' requests waiting
+    def attempt():
+        with request_slots:
+            return fn()
+
+    return with_retries(attempt, retries, backoff, retry_on=is_rate_limited)
+
+
+def map_bounded(fn, items, max_workers=None, retries=0, backoff=1.0, retry_on=is_rate_limited,
+                return_exceptions=False):
+    # fn(item) for every item on at most max_workers threads. Results are in the
+    # order of items; with return_exceptions a failed item's exception takes its
+    # place instead of being raised. The requests the tasks make take their own
+    # slots and retries (see request), so tasks are not retried by default.
+    items = list(items)
+    max_workers = max(1, min(max_workers or MAX_CONCURRENCY, MAX_CONCURRENCY, len(items) or 1))
+
+    def run(item):
+        return with_retries(lambda: fn(item), retries, backoff, retry_on)
+
+    # Tasks run in a copy of the caller's context (e.g. its timing spans)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, run, item) for item in items]
+
+    results = []
+    for future in futures:
+        error = future.exception()
+        if error is not None and not return_exceptions:
+            raise error
+        results.append(error if error is not None else future.result())
+    return results
@@ -0,0 +1,124 @@
+import os
+import json
+from functools import lru_cache
+
+import numpy as np
+
+# Bundled index of the 58 California counties (names, GEOIDs, centroids,
+# bounding boxes and outline geometries) so the pages can list counties and
+# center the map without asking Earth Engine. The bundled outlines come from
+# quantized Census TopoJSON and have only 5-35 vertices per county: they are
+# for lookup and display only. Classification ROIs come from county_roi (or
+# TIGER/2018/Counties on Earth Engine). build_county_index replaces the file
+# with TIGER geometries simplified to max_error metres.
+
+INDEX_PATH = os.path.join(os.path.dirname(__file__), 'ca_counties.json')
+# Optional full-resolution county polygons for local classification, in any
+# format geopandas reads with a NAME column (e.g. the TIGER/Line county shapefile)
+BOUNDARIES_PATH = os.environ.get('TNC_COUNTY_BOUNDARIES')
+# Margin in degrees around a bundled bounding box, larger than the outlines' error
+BBOX_PAD = 0.05
+
+
+def polygon_centroid(geometry):
+    # Area-weighted centroid of the outer rings
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    area_sum, cx, cy = 0.0, 0.0, 0.0
+    for polygon in polygons:
+        ring = np.asarray(polygon[0], dtype=np.float64)
+        x, y = ring[:-1, 0], ring[:-1, 1]
+        xn, yn = ring[1:, 0], ring[1:, 1]
+        cross = x * yn - xn * y
+        area_sum += cross.sum() / 2
+        cx += ((x + xn) * cross).sum() / 6
+        cy += ((y + yn) * cross).sum() / 6
+    return [cx / area_sum, cy / area_sum]
+
+
+def polygon_bounds(geometry):
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    coords = np.concatenate([np.asarray(polygon[0], dtype=np.float64) for polygon in polygons])
+    return [coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max()]
+
+
+def index_entry(name, geoid, geometry, digits=5):
+    return {
+        'name': name,
+        'geoid': geoid,
+        'centroid': [round(v, digits) for v in polygon_centroid(geometry)],
+        'bbox': [round(v, digits) for v in polygon_bounds(geometry)],
+        'geometry': geometry,
+    }
+
+
+@lru_cache(maxsize=None)
+def load_index(path=INDEX_PATH):
+    with open(path) as f:
+        index = json.load(f)
+    return {county['name']: county for county in index['counties']}
+
+
+def county_names():
+    return sorted(load_index())
+
+
+def get_county(name):
+    counties = load_index()
+    if name not in counties:
+        raise KeyError(f"Unknown California county: {name}")
+    return counties[name]
+
+
+def county_centroid(name):
+    return get_county(name)['centroid']
+
+
+def county_bounds(name):
+    return get_county(name)['bbox']
+
+
+def county_geometry(name):
+    return get_county(name)['geometry']
+
+
+@lru_cache(maxsize=None)
+def load_boundaries(path):
+    # GeoJSON geometries by county name; nationwide files are cut to California
+    import geopandas as gpd
+    frame = gpd.read_file(path)
+    if 'STATEFP' in frame.columns:
+        frame = frame[frame['STATEFP'] == '06']
+    frame = frame.to_crs(4326)
+    return {row.NAME: json.loads(json.dumps(row.geometry.__geo_interface__)) for row in frame.itertuples()}
+
+
+def county_roi(name, boundaries=None, pad=BBOX_PAD):
+    # Area to classify a county on without Earth Engine: its polygon from the
+    # boundary file if there is one, otherwise its bounding box with a margin,
+    # so that no part of the county is left out
+    boundaries = boundaries or BOUNDARIES_PATH
+    if boundaries:
+        geometries = load_boundaries(boundaries)
+        if name not in geometries:
+            raise KeyError(f"No county named {name} in {boundaries}")
+        return geometries[name]
+    xmin, ymin, xmax, ymax = county_bounds(name)
+    xmin, ymin, xmax, ymax = xmin - pad, ymin - pad, xmax + pad, ymax + pad
+    return {'type': 'Polygon', 'coordinates': [[[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]]}
+
+
+def build_county_index(path=INDEX_PATH, max_error=100):
+    # Rebuild the bundled file from TIGER/2018/Counties (one Earth Engine call)
+    import ee
+    counties = ee.FeatureCollection('TIGER/2018/Counties').filter(ee.Filter.eq('STATEFP', '06'))
+    simplified = counties.map(
+        lambda feature: ee.Feature(feature.geometry().simplify(max_error), {'NAME': feature.get('NAME'), 'GEOID': feature.get('GEOID')})
+    ).getInfo()
+
+    entries = [
+        index_entry(feature['properties']['NAME'], feature['properties']['GEOID'], feature['geometry'])
+        for feature in simplified['features']
+    ]
+    with open(path, 'w') as f:
+        json.dump({'source': 'TIGER/2018/Counties', 'counties': sorted(entries, key=lambda entry: entry['name'])}, f)
+    load_index.cache_clear()
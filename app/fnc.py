@@ -1,10 +1,25 @@
-import ee
-import pandas as pd
 from datetime import datetime as dt, timedelta
-import streamlit as st
+import io
 import os
-from functools import reduce
-import geopandas as gpd
+import json
+import time
+import hashlib
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from app.lazy import lazy_import
+from app.concurrency import map_bounded, request
+from app.session import client as ee
+
+# Heavy dependencies are imported on first use so pages and scripts only pay
+# for what they touch (geopandas is only needed by load_data). Earth Engine is
+# reached through the session client, which loads ee on first use as well
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+st = lazy_import('streamlit')
+gpd = lazy_import('geopandas')
 
 tooltip_file_uploader = "Only CSV files are accepted."
 tooltip_county = "Select a county for classification."
@@ -13,6 +28,41 @@ tooltip_date_input = "Date range for county (ideally 15 days)."
 tooltip_left_layer = "Select visualization for the left layer."
 tooltip_right_layer = "Select visualization for the right layer."
 
+# Feature registry: each index feature and the Sentinel-2 bands it is computed
+# from. Any other feature is a raw band and only needs itself.
+INDEX_INPUTS = {
+    'NDVI': ['B8', 'B4'],
+    'NDTI': ['B11', 'B12'],
+    'PGI': ['B8', 'B4', 'B3', 'B2'],
+    'PMLI': ['B11', 'B4'],
+    'RPGI': ['B8', 'B3', 'B2'],
+}
+S2_BANDS = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B8A', 'B9', 'B11', 'B12']
+
+# Model inputs shared by both pages, the CLI and the benchmarks
+DEFAULT_BANDS = [
+    # Spectrum Features
+    'B4', 'B3', 'B2', 'B6', 'B8', 'B11', 'B12',
+    # Index Features
+    'NDVI', 'NDTI', 'PGI', 'PMLI',
+]
+
+
+def feature_plan(features):
+    # (raw bands to read, indices to compute) for a feature list
+    unknown = [name for name in features if name not in INDEX_INPUTS and name not in S2_BANDS]
+    if unknown:
+        raise ValueError(f"Unknown features: {', '.join(unknown)}")
+    raw, index_names = [], []
+    for name in features:
+        if name in INDEX_INPUTS:
+            index_names.append(name)
+        for band in INDEX_INPUTS.get(name, [name]):
+            if band not in raw:
+                raw.append(band)
+    return raw, index_names
+
+
 # Cloud mask for Sentinel-2
 def maskS2clouds(image):
     qa = image.select('QA60')
@@ -23,7 +73,12 @@ def maskS2clouds(image):
     return image.updateMask(mask).divide(10000)
 
 
-def processImageCollection(imageCollection, aoi, startDate, endDate):
+def processImageCollection(imageCollection, aoi, startDate, endDate, cloud=20, features=None, keep=()):
+    # With a feature list only the raw bands those features need (plus QA60 and
+    # any `keep` bands) enter the graph, only the needed indices are computed,
+    # and the images come out with just the features and `keep`. Without one
+    # every band and index is kept.
+
     # Define functions for band calculations
     def addNDVI(image):
         ndvi = image.normalizedDifference(['B8', 'B4']).rename('NDVI')
@@ -55,102 +110,781 @@ def processImageCollection(imageCollection, aoi, startDate, endDate):
         rpgi = B.multiply(100).divide(NIR.add(B).add(G).divide(3).subtract(1)).rename('RPGI')
         return image.addBands(rpgi)
 
+    builders = {'NDVI': addNDVI, 'NDTI': addNDTI, 'PGI': addPGI, 'PMLI': addPMLI, 'RPGI': addRPGI}
+
     # Apply functions to image collection
     processedCollection = (imageCollection
                            .filterDate(startDate, endDate)
                            .filterBounds(aoi)
-                           .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 20))
-                           .map(maskS2clouds)
-                           .map(addNDVI)
-                           .map(addNDTI)
-                           .map(addPGI)
-                           .map(addPMLI)
-                           .map(addRPGI))
+                           .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', cloud)))
+    if features is None:
+        index_names = list(builders)
+        processedCollection = processedCollection.map(maskS2clouds)
+    else:
+        raw, index_names = feature_plan(features)
+        inputs = raw + ['QA60'] + [band for band in keep if band not in raw]
+        processedCollection = processedCollection.map(lambda image: maskS2clouds(image.select(inputs)))
+    for name in index_names:
+        processedCollection = processedCollection.map(builders[name])
+    if features is not None:
+        processedCollection = processedCollection.select(list(features) + [band for band in keep if band not in features])
 
     return processedCollection
-    
 
-def get_collection_on_date(df, county, date, roi, bands):
-    # Filter for date
-    df_date = df[df["Date"]==date]
-
-    # Get coordinates as a list
-    points = []
-    for idx, row in df_date.iterrows():
-        point = ee.Geometry.Point([row['Longitude'], row['Latitude']])
-        feature = ee.Feature(point, {'class': row['NumericType']})
-        points.append(feature)
-
-    fc = ee.FeatureCollection(points)
-
-    # Get image for a month's range
-    date_ = dt.strptime(date, "%Y-%m-%d")
-    start = (date_ - timedelta(days=15)).strftime("%Y-%m-%d")
-    end = (date_ + timedelta(days=15)).strftime("%Y-%m-%d")
-    processedCollection = processImageCollection(ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED'), roi, start, end)
-    image = processedCollection.median().clip(roi)
-
-    # Sample points from image
-    data = image.select(bands).sampleRegions(
-        collection=fc,
-        properties=['class'],
-        scale=30,
-        geometries=True
-    )
 
-    print(f"Total number of labeled data for {date} in {county}:", data.size().getInfo())
+class LRUCache:
+    # Thread-safe least recently used cache shared by every session in the process
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        # (value, hit): hit is False when factory() built the value
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return self._items[key], True
+            self.misses += 1
+
+        value = factory()
+        self.put(key, value)
+        return value, False
+
+    def lookup(self, key):
+        # (found, value) without creating anything
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return True, self._items[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items), 'maxsize': self.maxsize}
+
+
+# Local backend composites. They are NumPy stacks of a whole ROI, so only a few are kept
+composite_cache = LRUCache(maxsize=8)
+# Map tile URLs by layer content and visualization. Each new one costs a
+# blocking getMapId round trip; Earth Engine map ids stay valid for hours, and
+# entries older than TILE_URL_MAX_AGE seconds are requested again
+tile_cache = LRUCache(maxsize=128)
+TILE_URL_MAX_AGE = 3600
+
+
+class Timer:
+    # Nested timing spans for one unit of work (a Streamlit rerun, a CLI job).
+    #   with fnc.span('training', trees=50): ...
+    # Every finished span is also added to the process-wide span_totals.
+    def __init__(self, name='rerun', max_spans=10000):
+        self.name = name
+        self.run_id = f"{dt.now().strftime('%Y%m%dT%H%M%S')}-{id(self) & 0xffff:04x}"
+        self.started = time.time()
+        self.spans = deque(maxlen=max_spans)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self):
+        # Nesting is tracked per thread so pool workers can share one timer
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, **labels):
+        record = {
+            'name': name,
+            'parent': self._stack[-1]['name'] if self._stack else None,
+            'depth': len(self._stack),
+            'start': time.time() - self.started,
+            'duration': None,
+            'labels': labels,
+        }
+        self._stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record['labels']['error'] = type(e).__name__
+            raise
+        finally:
+            record['duration'] = time.perf_counter() - start
+            self._stack.pop()
+            with self._lock:
+                self.spans.append(record)
+            add_span_total(name, record['duration'])
+
+    def summary(self):
+        # Total time and count per span name, slowest first
+        totals = {}
+        for record in self.spans:
+            total = totals.setdefault(record['name'], {'name': record['name'], 'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += record['duration']
+        return sorted(totals.values(), key=lambda total: total['seconds'], reverse=True)
+
+    def to_jsonl(self):
+        lines = []
+        for record in sorted(self.spans, key=lambda record: record['start']):
+            lines.append(json.dumps({'run': self.run_id, 'timer': self.name, **record}, default=str))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+span_totals = {}
+span_totals_lock = threading.Lock()
+current_timer = contextvars.ContextVar('current_timer', default=None)
+METRICS_DIR = os.environ.get('TNC_METRICS_DIR')
+
+
+def add_span_total(name, seconds):
+    with span_totals_lock:
+        total = span_totals.setdefault(name, {'count': 0, 'seconds': 0.0})
+        total['count'] += 1
+        total['seconds'] += seconds
+
+
+def start_timer(name='rerun'):
+    # New timer for the calling thread (each Streamlit session reruns in its own thread)
+    timer = Timer(name)
+    current_timer.set(timer)
+    return timer
+
+
+def get_timer():
+    timer = current_timer.get()
+    return timer if timer is not None else start_timer('process')
+
+
+def span(name, **labels):
+    return get_timer().span(name, **labels)
+
+
+def timed(name):
+    # Decorator form of span for whole functions
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, function=fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_info(obj, **labels):
+    # Every getInfo round trip to Earth Engine goes through here, under a request
+    # slot and with backoff on rate limits
+    with span('getInfo', **labels):
+        return request(obj.getInfo)
+
+
+evaluation_cache = LRUCache(maxsize=256)
+evaluation_stats = {'requested': 0, 'cached': 0, 'duplicates': 0, 'round_trips': 0}
+evaluation_lock = threading.Lock()
+
+
+class Deferred:
+    # Handle for a value queued on a Batch; .value is set once the batch resolves
+    def __init__(self, batch, key):
+        self.batch = batch
+        self.key = key
+
+    @property
+    def value(self):
+        if self.key not in self.batch.results:
+            self.batch.resolve()
+        return self.batch.results[self.key]
+
+
+class Batch:
+    # Collects deferred Earth Engine values and fetches all of them in one getInfo.
+    # Identical objects (same serialized graph) are requested once, and results are
+    # memoized process wide so later batches reuse them. Without memoize the graphs
+    # are not serialized for keys; only repeats of the same object are merged.
+    #   batch = fnc.Batch()
+    #   matrix, accuracy = batch.add(errors), batch.add(errors.accuracy())
+    #   batch.resolve(); matrix.value
+    def __init__(self, memoize=True):
+        self.memoize = memoize
+        self.pending = OrderedDict()
+        self.results = {}
+        self.requested = 0
+
+    def add(self, obj):
+        key = evaluation_key(obj) if self.memoize else ('object', id(obj))
+        self.requested += 1
+        if key not in self.results and key not in self.pending:
+            found, value = evaluation_cache.lookup(key) if self.memoize else (False, None)
+            if found:
+                self.results[key] = value
+                record_evaluation(cached=1)
+            else:
+                self.pending[key] = obj
+        else:
+            record_evaluation(duplicates=1)
+        record_evaluation(requested=1)
+        return Deferred(self, key)
+
+    def resolve(self):
+        if self.pending:
+            keys, objs = list(self.pending), list(self.pending.values())
+            values = get_info(ee.List(objs), what='batch', values=len(objs), requested=self.requested)
+            for key, value in zip(keys, values):
+                self.results[key] = value
+                if self.memoize:
+                    evaluation_cache.put(key, value)
+            self.pending.clear()
+            record_evaluation(round_trips=1)
+        return self
+
+
+def evaluation_key(obj):
+    return hashlib.sha256(obj.serialize().encode('utf-8')).hexdigest()
+
+
+def record_evaluation(**counts):
+    with evaluation_lock:
+        for name, count in counts.items():
+            evaluation_stats[name] += count
+
+
+def evaluate(*objs, memoize=True):
+    # Values of several Earth Engine objects in (at most) one round trip
+    batch = Batch(memoize)
+    handles = [batch.add(obj) for obj in objs]
+    batch.resolve()
+    return [handle.value for handle in handles]
+
+
+def coalesced_calls():
+    # getInfo calls saved so far: every requested value minus the round trips made
+    with evaluation_lock:
+        return {**evaluation_stats, 'coalesced': evaluation_stats['requested'] - evaluation_stats['round_trips']}
+
+
+def prometheus_text(prefix='tnc'):
+    # Process totals in the Prometheus text exposition format
+    with span_totals_lock:
+        totals = sorted(span_totals.items())
+    lines = [
+        f'# HELP {prefix}_span_seconds_total Time spent in each instrumented stage.',
+        f'# TYPE {prefix}_span_seconds_total counter',
+    ]
+    lines += [f'{prefix}_span_seconds_total{{span="{name}"}} {total["seconds"]:.6f}' for name, total in totals]
+    lines += [
+        f'# HELP {prefix}_span_count_total Number of times each instrumented stage ran.',
+        f'# TYPE {prefix}_span_count_total counter',
+    ]
+    lines += [f'{prefix}_span_count_total{{span="{name}"}} {total["count"]}' for name, total in totals]
+    return '\n'.join(lines) + '\n'
+
+
+def export_metrics(timer, metrics_dir=None):
+    # Append the rerun's spans to spans.jsonl and rewrite metrics.prom (for a textfile collector)
+    metrics_dir = metrics_dir or METRICS_DIR
+    if not metrics_dir:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    with open(os.path.join(metrics_dir, 'spans.jsonl'), 'a') as f:
+        f.write(timer.to_jsonl())
+    path = os.path.join(metrics_dir, 'metrics.prom')
+    with open(path + '.tmp', 'w') as f:
+        f.write(prometheus_text())
+    os.replace(path + '.tmp', path)
+
+
+def performance_panel(timer=None):
+    # Sidebar breakdown of the current rerun with JSON lines / Prometheus downloads
+    from app import lazy
+    timer = timer or get_timer()
+    export_metrics(timer)
+    with st.sidebar.expander("Performance", expanded=False):
+        summary = timer.summary()
+        total = time.time() - timer.started
+        st.caption(f"Rerun {timer.run_id}: {total:.2f} s total")
+        if summary:
+            st.dataframe(pd.DataFrame(summary).set_index('name'), use_container_width=True)
+            st.dataframe(pd.DataFrame([
+                {'span': '  ' * record['depth'] + record['name'], 'seconds': record['duration'],
+                 'labels': json.dumps(record['labels'], default=str)}
+                for record in sorted(timer.spans, key=lambda record: record['start'])
+            ]), use_container_width=True, hide_index=True)
+        evaluations = coalesced_calls()
+        st.caption(f"Earth Engine values: {evaluations['requested']} requested, {evaluations['round_trips']} round trips "
+                   f"({evaluations['coalesced']} coalesced, {evaluations['cached']} from cache)")
+        imports = lazy.import_report(top=10)
+        if imports:
+            st.caption("Slowest imports")
+            st.dataframe(pd.DataFrame(imports, columns=['module', 'seconds']), use_container_width=True, hide_index=True)
+        st.download_button("Spans (JSON lines)", timer.to_jsonl(), file_name=f"spans-{timer.run_id}.jsonl")
+        st.download_button("Metrics (Prometheus)", prometheus_text(), file_name="metrics.prom")
+
+
+def session_panel():
+    # Sidebar status of the process-wide Earth Engine session; the health check
+    # is a round trip, so it only runs when asked for
+    from app import session
+    with st.sidebar.expander("Earth Engine session", expanded=False):
+        current = session.get_session()
+        if current.initialized:
+            st.caption(f"Initialized {dt.fromtimestamp(current.initialized_at):%Y-%m-%d %H:%M:%S}")
+        if st.button("Check connection"):
+            status = session.health()
+            if status['ok']:
+                st.success(f"Connected ({status['latency'] * 1000:.0f} ms)")
+            else:
+                st.error(f"Earth Engine unavailable: {status['error']}")
+
+COMPOSITE_METHODS = ['median', 'mean', 'percentile', 'quality']
+tooltip_composite = "How the scenes in the date range are combined (quality keeps the least cloudy pixel)."
+
+
+def reduce_collection(collection, method='median', percentile=50):
+    # Per-pixel composite of a processed collection
+    if method == 'median':
+        return collection.median()
+    if method == 'mean':
+        return collection.mean()
+    if method == 'percentile':
+        # The reducer appends _p<percentile> to every band name
+        return collection.reduce(ee.Reducer.percentile([percentile])).regexpRename(f'_p{percentile}$', '')
+    if method == 'quality':
+        # Lowest cloud probability wins (MSK_CLDPRB, scaled with the other bands)
+        def add_quality(image):
+            return image.addBands(image.select('MSK_CLDPRB').multiply(-1).rename('QUALITY'))
+        return collection.map(add_quality).qualityMosaic('QUALITY')
+    raise ValueError(f"Unknown composite method '{method}' (expected one of {', '.join(COMPOSITE_METHODS)})")
+
+
+def composite_key(collection_id, roi, start, end, cloud, bands, method='median', percentile=50, scenes=None):
+    # Stable hash of everything that defines a composite
+    roi_key = roi.serialize() if hasattr(roi, 'serialize') else json.dumps(roi, sort_keys=True)
+    payload = json.dumps([collection_id, roi_key, str(start), str(end), cloud, list(bands) if bands else None,
+                          method, percentile if method == 'percentile' else None, scenes])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_composite(collection_id, roi, start, end, cloud=20, bands=None, method='median', percentile=50):
+    # Composite clipped to the ROI. This only builds the Earth Engine graph, so
+    # there is nothing worth caching here; tile_layer caches what the map fetches
+    with span('composite', collection=collection_id, start=str(start), end=str(end), method=method):
+        # Quality mosaics also need the cloud probability band
+        keep = ['MSK_CLDPRB'] if method == 'quality' else []
+        processedCollection = processImageCollection(ee.ImageCollection(collection_id), roi, start, end, cloud, bands or None, keep)
+        image = reduce_collection(processedCollection, method, percentile).clip(roi)
+        if bands:
+            image = image.select(bands)
+        return image
+
+
+def tile_layer(ee_object, vis_params, name):
+    # Folium tile layer for an Earth Engine object, shared across sessions and
+    # pages: only the first request for a layer's content pays the getMapId
+    import folium
+    import geemap.foliumap as geemap
+    key = hashlib.sha256(json.dumps([ee_object.serialize(), vis_params], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    found, entry = tile_cache.lookup(key)
+    if found and time.time() - entry[0] < TILE_URL_MAX_AGE:
+        return folium.raster_layers.TileLayer(tiles=entry[1], attr="Google Earth Engine", name=name, overlay=True,
+                                              control=True, max_zoom=24)
+    layer = request(lambda: geemap.ee_tile_layer(ee_object, vis_params, name))
+    tile_cache.put(key, (time.time(), layer.tiles))
+    return layer
+
+
+def group_survey_dates(dates, days=15, max_span=None):
+    # Merge survey dates whose +/- days windows overlap into shared windows. A
+    # merged window never spans more than max_span days (3 * days by default,
+    # i.e. its dates lie within `days` of each other), so a run of dates does
+    # not chain into one composite covering months.
+    max_span = timedelta(days=max_span if max_span is not None else 3 * days)
+    windows = []
+    for date in sorted(set(dates)):
+        date_ = dt.strptime(date, "%Y-%m-%d")
+        start = date_ - timedelta(days=days)
+        end = date_ + timedelta(days=days)
+        if windows and start < windows[-1][1] and end - windows[-1][0] <= max_span:
+            windows[-1][1] = end
+            windows[-1][2].append(date)
+        else:
+            windows.append([start, end, [date]])
+
+    return [(start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"), group) for start, end, group in windows]
+
+
+def get_backend(name=None):
+    # Compute backend for this run (Earth Engine unless TNC_BACKEND says otherwise)
+    from app.backend import get_backend as _get_backend
+    return _get_backend(name)
+
+
+def get_collection_on_window(df, dates, start, end, roi, bands, backend=None):
+    backend = backend or get_backend()
+
+    # Filter for the survey dates sharing this window
+    df_dates = df[df["Date"].isin(dates)]
+
+    # Get coordinates as a single feature collection
+    fc = backend.points(df_dates)
+
+    # One composite for the whole window, with only the bands the model uses
+    image = backend.composite('COPERNICUS/S2_SR_HARMONIZED', roi, start, end, bands=bands)
+
+    # Sample points from image (lazy, nothing is sent until the collection is used)
+    with span('sampling', start=start, end=end):
+        data = backend.sample_regions(image, fc, bands, properties=['class'], scale=30)
 
     return data
 
 
+def get_collection_on_date(df, county, date, roi, bands, backend=None):
+    # Get image for a month's range around a single date
+    (start, end, dates), = group_survey_dates([date])
+    return get_collection_on_window(df, dates, start, end, roi, bands, backend)
+
+
+points_cache = LRUCache(maxsize=64)
+
+
+def points_geojson(df):
+    # Memoized on the content of the three columns, so each file is converted once
+    columns = df[['Longitude', 'Latitude', 'NumericType']]
+    key = hashlib.sha256(pd.util.hash_pandas_object(columns, index=False).to_numpy().tobytes()).hexdigest()
+    return points_cache.get_or_create(key, lambda: build_points_geojson(columns))[0]
+
+
+def build_points_geojson(df):
+    # Drop rows without a class (e.g. types missing from the class mapping)
+    df = df.dropna(subset=['NumericType'])
+    lon = df['Longitude'].to_numpy(dtype=np.float64)
+    lat = df['Latitude'].to_numpy(dtype=np.float64)
+    classes = df['NumericType'].to_numpy().astype(np.int64)
+
+    # One MultiPoint per class keeps the payload down to the raw coordinate arrays
+    features = []
+    coords = np.column_stack([lon, lat])
+    for value in np.unique(classes):
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'MultiPoint', 'coordinates': coords[classes == value].tolist()},
+            'properties': {'class': int(value)},
+        })
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def explode_multipoint(feature):
+    # Split a class MultiPoint back into one point feature per label (server side)
+    feature = ee.Feature(feature)
+    value = feature.get('class')
+    points = feature.geometry().geometries().map(
+        lambda point: ee.Feature(ee.Geometry(point), {'class': value})
+    )
+    return ee.FeatureCollection(points)
+
+
+def get_points_fc(df):
+    # Build the labeled points from the Longitude/Latitude/NumericType columns in one go
+    geojson = points_geojson(df)
+    return ee.FeatureCollection(geojson).map(explode_multipoint).flatten()
+
+
 def get_data_as_points(df):
-    points = []
-    for idx, row in df.iterrows():
-        point = ee.Geometry.Point([row['Longitude'], row['Latitude']])
-        feature = ee.Feature(point, {'class': row['NumericType']})
-        points.append(feature)
+    return get_points_fc(df)
+
+
+decimate_cache = LRUCache(maxsize=64)
+class_colors = ['red', 'green', 'blue', 'yellow']
+
+
+def decimate_points(df, zoom):
+    # Keep one point per class in each grid cell roughly four screen pixels wide at this zoom
+    columns = df[['Longitude', 'Latitude', 'NumericType']].dropna()
+    key = hashlib.sha256(pd.util.hash_pandas_object(columns, index=False).to_numpy().tobytes() + str(zoom).encode()).hexdigest()
+
+    def build():
+        cell = 4 * 360 / (256 * 2 ** zoom)
+        lon = columns['Longitude'].to_numpy()
+        lat = columns['Latitude'].to_numpy()
+        classes = columns['NumericType'].to_numpy().astype(np.int64)
+        keys = np.column_stack([np.floor(lon / cell), np.floor(lat / cell), classes])
+        _, first, counts = np.unique(keys, axis=0, return_index=True, return_counts=True)
+        return pd.DataFrame({
+            'Longitude': lon[first],
+            'Latitude': lat[first],
+            'NumericType': classes[first],
+            'count': counts,
+        })
+
+    return decimate_cache.get_or_create(key, build)[0]
+
+
+def ground_truth_layer(df, name, zoom=16):
+    # Client-side layer: decimated points clustered per zoom level by Leaflet, no EE tiles
+    from folium.plugins import FastMarkerCluster
+    points = decimate_points(df, zoom)
+    data = points[['Latitude', 'Longitude', 'NumericType']].to_numpy().tolist()
+    callback = """
+    function (row) {
+        var colors = %s;
+        return L.circleMarker(new L.LatLng(row[0], row[1]), {
+            radius: 5, color: '#1e90ff', weight: 1, fillColor: colors[row[2]], fillOpacity: 1
+        });
+    }
+    """ % json.dumps(class_colors)
+    options = {'disableClusteringAtZoom': zoom + 1, 'maxClusterRadius': 40, 'chunkedLoading': True}
+    return FastMarkerCluster(data, callback=callback, options=options, name=name)
+
+
+LABEL_DTYPES = {'Location': 'string', 'Date': 'string', 'Type': 'category', 'Longitude': 'float64', 'Latitude': 'float64'}
+LABEL_COLUMNS = ['Date', 'Type', 'Longitude', 'Latitude']
+DATE_FORMAT = '%m/%d/%Y'
+S2_START = '2018-05-09'
+CACHE_DIR = os.environ.get('TNC_CACHE_DIR', '.cache')
+
+
+class LabelSchemaError(ValueError):
+    pass
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_bytes(source):
+    # Raw bytes of a path or an uploaded file
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read()
+    return source.getvalue()
+
+
+def parse_labels(data):
+    # Explicit dtypes, one date format and a schema check
+    try:
+        df = pd.read_csv(io.BytesIO(data), dtype=LABEL_DTYPES, encoding='utf-8-sig')
+    except ValueError as e:
+        raise LabelSchemaError(f"Unexpected values in label columns: {e}") from e
+
+    missing = [column for column in LABEL_COLUMNS if column not in df.columns]
+    if missing:
+        raise LabelSchemaError(f"Missing columns: {', '.join(missing)}")
+    if df[LABEL_COLUMNS].isna().any().any():
+        raise LabelSchemaError("Date, Type, Longitude and Latitude must not be empty")
+    if not (df['Longitude'].between(-180, 180).all() and df['Latitude'].between(-90, 90).all()):
+        raise LabelSchemaError("Longitude/Latitude out of range")
+
+    try:
+        df['Date'] = pd.to_datetime(df['Date'], format=DATE_FORMAT)
+    except ValueError as e:
+        raise LabelSchemaError(f"Dates must look like 06/02/2021: {e}") from e
+    return df
+
+
+@timed('ingestion.read_labels')
+def read_labels(source):
+    # Parsed tables are cached as Parquet under the hash of the file bytes, so
+    # re-reading the same content is free and edited files are always re-parsed
+    data = file_bytes(source)
+    key = content_key(data)
+    path = os.path.join(CACHE_DIR, 'labels', f'{key}.parquet')
+    if os.path.exists(path):
+        return pd.read_parquet(path), key
+
+    df = parse_labels(data)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return df, key
+
+
+def encode_labels(types, class_mapping):
+    # Map each category once instead of every row
+    if isinstance(types.dtype, pd.CategoricalDtype):
+        lookup = np.array([class_mapping.get(value, np.nan) for value in types.cat.categories] + [np.nan], dtype=np.float64)
+        return pd.Series(lookup[types.cat.codes.to_numpy()], index=types.index)
+    return types.map(class_mapping)
+
+
+def survey_dates(dates):
+    # Already parsed dates pass through; raw strings use the single known format
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    return pd.to_datetime(dates, format=DATE_FORMAT)
+
+
+def dedupe_pixels(df, scale=30, majority_vote=False):
+    # Snap points to the EPSG:4326 grid sampleRegions uses at this scale and keep
+    # one row per (date, pixel, class). With majority_vote each (date, pixel)
+    # keeps only its most common class (ties go to the class seen first).
+    from app.tiling import DEGREES_PER_METER
+    step = scale * DEGREES_PER_METER
+    cells = pd.DataFrame({
+        'Date': df['Date'].to_numpy(),
+        'row': np.floor(df['Latitude'].to_numpy(dtype=np.float64) / step).astype(np.int64),
+        'col': np.floor(df['Longitude'].to_numpy(dtype=np.float64) / step).astype(np.int64),
+        'class': df['NumericType'].fillna(-1).to_numpy(),
+    }, index=df.index)
+    pixel = ['Date', 'row', 'col']
+
+    conflicts = int((cells.groupby(pixel, sort=False)['class'].nunique() > 1).sum())
+    if majority_vote:
+        votes = cells.groupby(pixel + ['class'], sort=False)['class'].transform('size')
+        order = votes.sort_values(ascending=False, kind='stable').index
+        keep = order[~cells.loc[order].duplicated(pixel).to_numpy()]
+        mask = df.index.isin(keep)
+    else:
+        mask = ~cells.duplicated(pixel + ['class']).to_numpy()
+
+    stats = {'rows': len(df), 'removed': int(len(df) - mask.sum()), 'conflicts': conflicts}
+    return df[mask], stats
+
+
+def cluster_points(lon, lat, distance=1000, pad=30):
+    # Grid spatial index: points are bucketed into cells of `distance` metres and
+    # touching occupied cells (8-neighbourhood) form one cluster. Returns a
+    # cluster label per point and a padded bounding box per cluster.
+    from app.tiling import DEGREES_PER_METER
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    cell = distance * DEGREES_PER_METER
+    cells, cell_index = np.unique(
+        np.column_stack([np.floor(lon / cell), np.floor(lat / cell)]).astype(np.int64),
+        axis=0, return_inverse=True,
+    )
+    cell_index = cell_index.ravel()
+
+    # Flood fill over the occupied cells only
+    position = {(int(x), int(y)): i for i, (x, y) in enumerate(cells)}
+    cell_cluster = np.full(len(cells), -1, dtype=np.int64)
+    clusters = 0
+    for i in range(len(cells)):
+        if cell_cluster[i] >= 0:
+            continue
+        cell_cluster[i] = clusters
+        stack = [i]
+        while stack:
+            x, y = cells[stack.pop()]
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    j = position.get((int(x + dx), int(y + dy)))
+                    if j is not None and cell_cluster[j] < 0:
+                        cell_cluster[j] = clusters
+                        stack.append(j)
+        clusters += 1
+
+    labels = cell_cluster[cell_index]
+    pad = pad * DEGREES_PER_METER
+    bounds = []
+    for cluster in range(clusters):
+        members = labels == cluster
+        bounds.append((float(lon[members].min() - pad), float(lat[members].min() - pad),
+                       float(lon[members].max() + pad), float(lat[members].max() + pad)))
+
+    # Merge clusters whose boxes overlap so the boxes form a valid MultiPolygon
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(bounds)):
+            for j in range(i + 1, len(bounds)):
+                a, b = bounds[i], bounds[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    bounds[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del bounds[j]
+                    labels[labels == j] = i
+                    labels[labels > j] -= 1
+                    merged = True
+                    break
+            if merged:
+                break
+    return labels, bounds
+
 
-    return points
+def bounds_area(bounds_list):
+    return sum((xmax - xmin) * (ymax - ymin) for xmin, ymin, xmax, ymax in bounds_list)
 
 
-def processData(df, county, class_mapping, bands):
+@timed('processData')
+def processData(df, county, class_mapping, bands, backend=None, dedupe=True, majority_vote=False):
+    backend = backend or get_backend()
+
     # Encode labels
-    df['NumericType'] = df['Type'].map(class_mapping)
+    df['NumericType'] = encode_labels(df['Type'], class_mapping)
 
     # Drop green house type (for now)
     df = df[df["Type"]!="green house"]
 
-    # Format dates to YYYY-MM-DD
-    df['Date'] = pd.to_datetime(df['Date']).dt.strftime('%Y-%m-%d')
-
     # Filter for dates when Sentinel-2 is available
-    df = df[df['Date'] > '2018-05-09'] 
+    dates = survey_dates(df['Date'])
+    df = df[dates > pd.Timestamp(S2_START)].copy()
 
-    # County boundaries based off csv coordinates
-    min_lon = df['Longitude'].min()
-    max_lon = df['Longitude'].max()
-    min_lat = df['Latitude'].min()
-    max_lat = df['Latitude'].max()
+    # Format dates to YYYY-MM-DD
+    df['Date'] = dates.loc[df.index].dt.strftime('%Y-%m-%d')
+
+    # Several labels inside one 30 m pixel would be sampled as the same pixel
+    if dedupe:
+        with span('dedupe', county=county) as record:
+            df, stats = dedupe_pixels(df, scale=30, majority_vote=majority_vote)
+            record['labels'].update(stats)
 
-    roi = ee.Geometry.Rectangle([min_lon, min_lat, max_lon, max_lat])
+    # Compact boxes around each group of nearby points instead of one rectangle over the file
+    with span('clustering', county=county) as record:
+        clusters, cluster_bounds = cluster_points(df['Longitude'], df['Latitude'])
+        full_bounds = (df['Longitude'].min(), df['Latitude'].min(), df['Longitude'].max(), df['Latitude'].max())
+        # Share of the bounding rectangle the clusters cover (0 when no rows are left)
+        coverage = bounds_area(cluster_bounds) / max(bounds_area([full_bounds]), 1e-12) if len(df) else 0.0
+        record['labels'].update({'clusters': len(cluster_bounds), 'coverage': coverage})
 
-    # Iterate through unique dates
-    dates = df["Date"].unique()
+    # Sample each group of overlapping survey dates from one shared composite,
+    # built only over the clusters that have points in that window
     all_county_data = []
-    for date in dates:
-        all_county_data.append(get_collection_on_date(df, county, date, roi, bands))
-    county_fc = ee.FeatureCollection(all_county_data).flatten()
-    print(f"Total number of labeled data in {county}:", county_fc.size().getInfo())
+    for start, end, dates in group_survey_dates(df["Date"].unique()):
+        in_window = df["Date"].isin(dates).to_numpy()
+        roi = backend.rectangles([cluster_bounds[i] for i in np.unique(clusters[in_window])])
+        all_county_data.append(get_collection_on_window(df, dates, start, end, roi, bands, backend))
+    county_fc = backend.merge(all_county_data)
 
     return county_fc
 
 
+def get_sample_counts(fcs, backend=None):
+    # Resolve the sizes of several collections in a single round trip
+    backend = backend or get_backend()
+    names = list(fcs)
+    if backend.name != 'ee':
+        return {name: backend.size(fcs[name]) for name in names}
+    # Training collections are rarely counted twice, so their (large) graphs are not hashed
+    sizes = evaluate(*[ee.FeatureCollection(fcs[name]).size() for name in names], memoize=False)
+    return dict(zip(names, sizes))
+
+
 def get_centroid_coordinates(county_name, counties):
     # Filter the FeatureCollection to the selected county
     selected_county = counties.filter(ee.Filter.eq('NAME', county_name))
 
     # Calculate the centroid
-    centroid = selected_county.geometry().centroid().getInfo()['coordinates']
+    centroid, = evaluate(selected_county.geometry().centroid())
+    centroid = centroid['coordinates']
 
     return centroid
 
@@ -161,24 +895,175 @@ def get_centroid_coordinates(county_name, counties):
 #     return feature.set('color', color)
 
 
-def load_data_df(uploaded_files, class_mapping, bands):
-    dfs = []
-    for file in uploaded_files:
-        df = pd.read_csv(file)
+def load_data_df(uploaded_files, class_mapping, bands, backend=None, max_workers=None):
+    backend = backend or get_backend()
+
+    # Each file is read and turned into its training collection in parallel
+    def prepare(file):
+        df, _ = read_labels(file)
+        return df, processData(df, file.name, class_mapping, bands, backend)
+
+    filenames, dfs, images = [], [], []
+    results = map_bounded(prepare, uploaded_files, max_workers=max_workers, return_exceptions=True)
+    for file, result in zip(uploaded_files, results):
+        # Errors are reported here because Streamlit calls only work on the script thread
+        if isinstance(result, LabelSchemaError):
+            st.error(f"Failed to load CSV file '{file.name}': {result}")
+            continue
+        if isinstance(result, Exception):
+            raise result
+        df, image = result
+        filenames.append(file.name)
         dfs.append(df)
+        images.append(image)
+
+    return filenames, dfs, images
+
+
+@timed('training')
+def train_rf(numtrees, data, bands, backend=None):
+    backend = backend or get_backend()
+    return backend.train_rf(numtrees, data, bands)
+
+
+class WarmStartForest:
+    # Keeps every tree grown so far on a cached training table. Growing the
+    # forest only trains the extra trees; shrinking reuses the first n trees.
+    def __init__(self, data, bands, backend=None, seed=0):
+        self.backend = backend or get_backend()
+        self.data = data
+        self.bands = bands
+        self.seed = seed
+        self.trees = []
+
+    @timed('training')
+    def resize(self, numtrees):
+        if numtrees > len(self.trees):
+            # Each batch gets its own seed so new trees differ from the existing ones
+            extra = self.backend.grow_trees(numtrees - len(self.trees), self.data, self.bands, seed=self.seed + len(self.trees))
+            self.trees.extend(extra)
+        return self.backend.ensemble(self.trees[:numtrees])
+
+    def error_matrix(self, model):
+        return self.backend.error_matrix(model, self.data, self.bands)
+
+
+def ee_importance(model):
+    # Lazy {band: importance} from an Earth Engine classifier's explain(), empty
+    # when the classifier reports none
+    return ee.Dictionary(model.explain()).get('importance', ee.Dictionary())
+
+
+def rank_importance(importance, bands):
+    # {band: share of the total importance} for the model bands, largest first.
+    # Bands the forest never split on get 0; {} if there is no importance at all.
+    values = {band: float((importance or {}).get(band) or 0) for band in bands}
+    total = sum(values.values())
+    if not total:
+        return {}
+    return dict(sorted(((band, value / total) for band, value in values.items()), key=lambda item: -item[1]))
+
+
+def feature_importance(model, bands, backend=None):
+    # Gini importance of each model band (local forests compute it from their
+    # trees, Earth Engine reports it in explain())
+    backend = backend or get_backend()
+    return rank_importance(backend.feature_importance(model, bands), bands)
+
 
-    images = []
-    if dfs:
-        for df, filename in zip(dfs, [file.name for file in uploaded_files]):
-            image = processData(df, filename, class_mapping, bands)
-            images.append(image)
+def format_importance(importance, top=None):
+    if not importance:
+        return "n/a"
+    return ', '.join(f"{band} {share:.1%}" for band, share in list(importance.items())[:top])
 
-    return dfs, images
 
+def importance_panel(importance):
+    # Sidebar chart of the feature importance; bands near zero are candidates
+    # for a cheaper reduced-band model
+    with st.sidebar.expander("Feature importance", expanded=False):
+        if not importance:
+            st.caption("This model does not report feature importance.")
+            return
+        st.bar_chart(pd.Series(importance, name='share'))
+        st.caption("Share of the forest's total Gini impurity decrease per band.")
 
-def train_rf(numtrees, data, bands):
-    model = ee.Classifier.smileRandomForest(numtrees)
-    return model.train(data, 'class', bands)
+
+# Bump whenever the artifact payload changes, so older artifacts are retrained
+# instead of failing at import (2: Earth Engine payloads carry their bands)
+MODEL_VERSION = 2
+MODEL_DIR = os.environ.get('TNC_MODEL_DIR', 'models')
+pretrained_models = {}
+pretrained_locks = {}
+pretrained_lock = threading.Lock()
+
+
+def pretrained_key(data_path, bands, class_mapping, **config):
+    # Content hash of every file under data_path plus the training configuration
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(data_path)):
+        for filename in sorted(files):
+            filepath = os.path.join(root, filename)
+            digest.update(os.path.relpath(filepath, data_path).encode('utf-8'))
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    digest.update(json.dumps([MODEL_VERSION, list(bands), class_mapping, config], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_artifact(path, key):
+    # Saved artifact at path if it matches the key and the current MODEL_VERSION
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        artifact = json.load(f)
+    if artifact.get('version') != MODEL_VERSION or artifact.get('key') != key:
+        return None
+    return artifact
+
+
+def get_pretrained_model(key, train, backend=None, model_dir=None):
+    # Memory first, then the artifact on disk, and only train when neither matches the key.
+    # Without an artifact of its own, a backend also accepts one from the backends
+    # it can import (the local backend runs Earth Engine trees).
+    # A lock per (backend, key) makes concurrent sessions wait for a single training
+    # run of that model without blocking sessions that load or train any other.
+    backend = backend or get_backend()
+    model_dir = model_dir or MODEL_DIR
+    cache_key = (backend.name, key)
+    if cache_key in pretrained_models:
+        return pretrained_models[cache_key]
+    with pretrained_lock:
+        lock = pretrained_locks.setdefault(cache_key, threading.Lock())
+    with lock:
+        if cache_key in pretrained_models:
+            return pretrained_models[cache_key]
+
+        path = os.path.join(model_dir, f"pretrained-{backend.name}-{key[:16]}.json")
+        artifact = read_artifact(path, key)
+        for name in backend.imports_from:
+            if artifact is None:
+                artifact = read_artifact(os.path.join(model_dir, f"pretrained-{name}-{key[:16]}.json"), key)
+
+        if artifact is None:
+            with span('training', artifact=os.path.basename(path)):
+                payload, metrics = backend.export_model(train())
+            artifact = {
+                'version': MODEL_VERSION,
+                'key': key,
+                'backend': backend.name,
+                'created': dt.now().isoformat(timespec='seconds'),
+                'metrics': metrics,
+                'model': payload,
+            }
+            os.makedirs(model_dir, exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(artifact, f)
+            os.replace(tmp_path, path)
+
+        pretrained_models[cache_key] = (backend.import_model(artifact['model']), artifact['metrics'])
+        return pretrained_models[cache_key]
 
 
 def check_data_exists(data_path, csv_filenames, shape_filenames):
@@ -205,12 +1090,71 @@ def check_data_exists(data_path, csv_filenames, shape_filenames):
     return True
 
 
-def load_data(data_path, csv_filenames, shape_filenames):
+SHAPE_COMPONENTS = ['shp', 'shx', 'dbf', 'prj', 'cpg']
+shape_payload_stats = {}
+
+
+def geojson_size(features):
+    return len(json.dumps(features, separators=(',', ':')))
+
+
+@timed('ingestion.compact_shapefile')
+def compact_shapefile(path, scale=30, grid_size=1e-5):
+    # Simplify to half a pixel at the sampling scale (in California Albers metres),
+    # snap coordinates to a ~1 m grid and cache the result as GeoParquet keyed by
+    # the shapefile contents. Returns the GeoJSON features and payload stats.
+    import shapely
+    base, _ = os.path.splitext(path)
+    digest = hashlib.sha256(json.dumps([scale, grid_size]).encode('utf-8'))
+    for ext in SHAPE_COMPONENTS:
+        if os.path.exists(f'{base}.{ext}'):
+            with open(f'{base}.{ext}', 'rb') as f:
+                digest.update(f.read())
+    name = os.path.basename(base)
+    cache_path = os.path.join(CACHE_DIR, 'shapes', f'{name}-{digest.hexdigest()[:16]}.parquet')
+    stats_path = cache_path[:-len('.parquet')] + '.json'
+
+    if os.path.exists(cache_path) and os.path.exists(stats_path):
+        compact = gpd.read_parquet(cache_path)
+        with open(stats_path) as f:
+            stats = json.load(f)
+    else:
+        original = gpd.read_file(path).to_crs(4326)
+        simplified = original.geometry.to_crs(3310).simplify(scale / 2, preserve_topology=True).to_crs(4326)
+        compact = original.set_geometry(shapely.set_precision(simplified.values, grid_size))
+        compact = compact[~compact.geometry.is_empty]
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        compact.to_parquet(cache_path + '.tmp')
+        os.replace(cache_path + '.tmp', cache_path)
+        stats = {
+            'features': len(compact),
+            'bytes_before': geojson_size(original.__geo_interface__['features']),
+            'vertices_before': int(shapely.get_num_coordinates(original.geometry.values).sum()),
+            'vertices_after': int(shapely.get_num_coordinates(compact.geometry.values).sum()),
+        }
+
+    # Only geometry and properties go over the wire
+    features = [
+        {'type': 'Feature', 'geometry': feature['geometry'], 'properties': feature['properties']}
+        for feature in compact.__geo_interface__['features']
+    ]
+    stats['bytes_after'] = geojson_size(features)
+    if not os.path.exists(stats_path):
+        with open(stats_path, 'w') as f:
+            json.dump(stats, f)
+    shape_payload_stats[name] = stats
+    return features, stats
+
+
+def load_data(data_path, csv_filenames, shape_filenames, backend=None):
+    backend = backend or get_backend()
+
     # Load in csv files
     csv_data = []
     for filename in csv_filenames:
         try:
-            df = pd.read_csv(os.path.join(data_path, filename) + '.csv')
+            df, _ = read_labels(os.path.join(data_path, filename) + '.csv')
             csv_data.append(df)
         except Exception as e:
             st.error(f"Failed to load CSV file '{filename}': {e}")
@@ -221,9 +1165,10 @@ def load_data(data_path, csv_filenames, shape_filenames):
         group_data = []
         for filename in group:
             try:
-                shapefile_gpd = gpd.read_file(os.path.join(data_path, f'{filename}.shp'))
-                shapefile_geojson = shapefile_gpd.__geo_interface__
-                shapefile = ee.FeatureCollection(shapefile_geojson['features'])
+                with span('shapes', file=filename) as record:
+                    features, stats = compact_shapefile(os.path.join(data_path, f'{filename}.shp'))
+                    record['labels'].update(stats)
+                shapefile = backend.feature_collection(features)
                 group_data.append(shapefile)
             except Exception as e:
                 st.error(f"Failed to load shape file '{filename}.shp': {e}")
@@ -232,33 +1177,25 @@ def load_data(data_path, csv_filenames, shape_filenames):
     return csv_data, shape_data
 
 
-def merge_polygons(poly1, poly2):
-    return poly1.merge(poly2)
-
+def create_fc_csv(csv_data, csv_filenames, class_mapping, bands, backend=None, max_workers=None):
+    backend = backend or get_backend()
+    return map_bounded(
+        lambda source: processData(source[0], source[1], class_mapping, bands, backend),
+        zip(csv_data, csv_filenames), max_workers=max_workers,
+    )
 
-def create_fc_csv(csv_data, csv_filenames, class_mapping, bands):
-    fcs = []
-    for data, filename in zip(csv_data, csv_filenames):
-        fc = processData(data, filename, class_mapping, bands)
-        fcs.append(fc)
-    return fcs
 
+def create_fc_shape(shape_data, dates, backend=None, max_workers=None, bands=None):
+    backend = backend or get_backend()
 
-def create_fc_shape(shape_data, dates):
-    fcs = []
-    for i, group in enumerate(shape_data):
+    def prepare(i):
+        group = shape_data[i]
         # Merge polygons
-        polygons = reduce(merge_polygons, group[1:])
+        polygons = backend.merge(group[1:])
         # Create processed collection
         START = dates[i][0]
         END = dates[i][1]
-        processedCollection = processImageCollection(ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED'), group[0], START, END)
-        image = processedCollection.median().clip(group[0])
-        fc = image.sampleRegions(
-            collection=polygons,
-            properties=['class'],
-            scale=30,
-            geometries=True
-        )
-        fcs.append(fc)
-    return fcs
\ No newline at end of file
+        image = backend.composite('COPERNICUS/S2_SR_HARMONIZED', group[0], START, END, bands=bands)
+        return backend.sample_regions(image, polygons, bands, properties=['class'], scale=30)
+
+    return map_bounded(prepare, range(len(shape_data)), max_workers=max_workers)
\ No newline at end of file
@@ -0,0 +1,358 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Small NumPy random forest used by the local backend in place of
+# ee.Classifier.smileRandomForest. Defaults follow the Earth Engine ones:
+# sqrt(#features) variables per split, 50% bagging, leaves of at least one sample.
+# Prediction runs on FlatForest, the trees compiled into flat node tables.
+
+# Threads for predicting large blocks of pixels (TNC_PREDICT_WORKERS)
+PREDICT_WORKERS = int(os.environ.get('TNC_PREDICT_WORKERS', str(min(4, os.cpu_count() or 1))))
+BLOCK_SIZE = 65536
+
+
+class Node:
+    __slots__ = ('feature', 'threshold', 'left', 'right', 'label', 'gain')
+
+    def __init__(self, label, feature=-1, threshold=0.0, left=None, right=None, gain=0.0):
+        self.label = label
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        # Weighted Gini decrease of the split (samples x impurity drop)
+        self.gain = gain
+
+    def is_leaf(self):
+        return self.left is None
+
+
+def best_split(X, y, n_classes, features, min_leaf):
+    # Exhaustive Gini search over the candidate features
+    n = len(y)
+    best = (None, None, np.inf)
+    for feature in features:
+        order = np.argsort(X[:, feature], kind='stable')
+        values = X[order, feature]
+        onehot = np.zeros((n, n_classes))
+        onehot[np.arange(n), y[order]] = 1
+        left = np.cumsum(onehot, axis=0)[:-1]
+        right = left[-1] + onehot[-1] - left
+        n_left = np.arange(1, n)
+        n_right = n - n_left
+
+        gini_left = 1 - np.sum((left / n_left[:, None]) ** 2, axis=1)
+        gini_right = 1 - np.sum((right / n_right[:, None]) ** 2, axis=1)
+        impurity = (n_left * gini_left + n_right * gini_right) / n
+
+        # Only split between distinct values and keep both sides large enough
+        valid = (values[1:] > values[:-1]) & (n_left >= min_leaf) & (n_right >= min_leaf)
+        if not valid.any():
+            continue
+        impurity = np.where(valid, impurity, np.inf)
+        i = int(np.argmin(impurity))
+        if impurity[i] < best[2]:
+            threshold = (values[i] + values[i + 1]) / 2
+            best = (feature, threshold, impurity[i])
+    return best
+
+
+def grow_tree(X, y, n_classes, variables_per_split, rng, min_leaf=1):
+    root = Node(label=None)
+    stack = [(root, np.arange(len(y)))]
+    while stack:
+        node, idx = stack.pop()
+        counts = np.bincount(y[idx], minlength=n_classes)
+        node.label = int(np.argmax(counts))
+        if counts.max() == len(idx) or len(idx) < 2 * min_leaf:
+            continue
+
+        features = rng.choice(X.shape[1], size=variables_per_split, replace=False)
+        feature, threshold, impurity = best_split(X[idx], y[idx], n_classes, features, min_leaf)
+        if feature is None:
+            continue
+
+        goes_left = X[idx, feature] <= threshold
+        node.feature = int(feature)
+        node.threshold = float(threshold)
+        node.gain = float(len(idx) * (1 - np.sum((counts / len(idx)) ** 2) - impurity))
+        node.left = Node(label=None)
+        node.right = Node(label=None)
+        stack.append((node.left, idx[goes_left]))
+        stack.append((node.right, idx[~goes_left]))
+    return root
+
+
+def predict_tree(tree, x):
+    node = tree
+    while not node.is_leaf():
+        node = node.left if x[node.feature] <= node.threshold else node.right
+    return node.label
+
+
+class FlatForest:
+    # All trees of a forest in contiguous node tables (feature, threshold,
+    # children, label), so a block of pixels walks every tree at once with
+    # array gathers instead of Python objects. Leaves point to themselves.
+    # Goes left when x[feature] <= threshold, exactly like predict_tree
+    # (so NaN goes right).
+    def __init__(self, trees, n_classes):
+        features, thresholds, lefts, rights, labels, roots = [], [], [], [], [], []
+        offset = 0
+        for tree in trees:
+            rows = tree_to_list(tree)
+            roots.append(offset)
+            for index, row in enumerate(rows):
+                feature, threshold, left, right, label = row[:5]
+                leaf = left < 0
+                features.append(0 if leaf else feature)
+                thresholds.append(threshold)
+                lefts.append(offset + (index if leaf else left))
+                rights.append(offset + (index if leaf else right))
+                labels.append(label)
+            offset += len(rows)
+
+        self.n_classes = n_classes
+        self.feature = np.array(features, dtype=np.intp)
+        self.threshold = np.array(thresholds, dtype=np.float64)
+        self.left = np.array(lefts, dtype=np.intp)
+        self.right = np.array(rights, dtype=np.intp)
+        self.label = np.array(labels, dtype=np.intp)
+        self.roots = np.array(roots, dtype=np.intp)
+        self.leaf = self.left == np.arange(offset)
+
+    @property
+    def nbytes(self):
+        return sum(table.nbytes for table in (self.feature, self.threshold, self.left, self.right, self.label, self.leaf))
+
+    def leaves(self, X):
+        # Leaf reached in every tree, (pixels, trees). Only the (pixel, tree)
+        # pairs that have not reached a leaf yet take part in each step.
+        n_trees = len(self.roots)
+        node = np.tile(self.roots, len(X))
+        base = np.repeat(np.arange(len(X)) * X.shape[1], n_trees)
+        values = X.ravel()
+        active = np.flatnonzero(~self.leaf[node])
+        while active.size:
+            current = node[active]
+            go_left = values[base[active] + self.feature[current]] <= self.threshold[current]
+            current = np.where(go_left, self.left[current], self.right[current])
+            node[active] = current
+            active = active[~self.leaf[current]]
+        return node.reshape(len(X), n_trees)
+
+    def block_votes(self, X):
+        labels = self.label[self.leaves(X)]
+        offsets = np.arange(len(X))[:, None] * self.n_classes
+        counts = np.bincount((offsets + labels).ravel(), minlength=len(X) * self.n_classes)
+        return counts.reshape(len(X), self.n_classes).astype(np.int64)
+
+    def votes(self, X, block_size=BLOCK_SIZE, workers=None):
+        # Votes per class, (pixels, classes). Blocks of block_size pixels are
+        # spread over `workers` threads (the gathers release the GIL).
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        workers = PREDICT_WORKERS if workers is None else workers
+        blocks = [X[start:start + block_size] for start in range(0, len(X), block_size)]
+        if len(blocks) <= 1:
+            return self.block_votes(X)
+        if workers <= 1:
+            return np.concatenate([self.block_votes(block) for block in blocks])
+        with ThreadPoolExecutor(max_workers=min(workers, len(blocks))) as pool:
+            return np.concatenate(list(pool.map(self.block_votes, blocks)))
+
+
+class RandomForest:
+    def __init__(self, numtrees=50, variables_per_split=None, bag_fraction=0.5, min_leaf=1, seed=0):
+        self.numtrees = numtrees
+        self.variables_per_split = variables_per_split
+        self.bag_fraction = bag_fraction
+        self.min_leaf = min_leaf
+        self.seed = seed
+        self.trees = []
+        self.n_classes = 0
+        self._flat = None
+        self._flat_key = None
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.int64)
+        self.n_classes = int(y.max()) + 1
+        mtry = self.variables_per_split or max(1, int(np.sqrt(X.shape[1])))
+        rng = np.random.default_rng(self.seed)
+        bag = max(1, int(round(self.bag_fraction * len(y))))
+
+        self.trees = []
+        for _ in range(self.numtrees):
+            sample = rng.choice(len(y), size=bag, replace=True)
+            self.trees.append(grow_tree(X[sample], y[sample], self.n_classes, mtry, rng, self.min_leaf))
+        return self
+
+    def compiled(self):
+        # Node tables for the current trees, rebuilt whenever the trees change
+        key = (self.n_classes, tuple(map(id, self.trees)))
+        if self._flat_key != key:
+            self._flat = FlatForest(self.trees, self.n_classes)
+            self._flat_key = key
+        return self._flat
+
+    def votes(self, X, workers=None):
+        X = np.asarray(X, dtype=np.float64)
+        if len(X) == 0 or not self.trees:
+            return np.zeros((len(X), self.n_classes), dtype=np.int64)
+        return self.compiled().votes(X, workers=workers)
+
+    def reference_votes(self, X):
+        # Tree-by-tree walk over Python nodes; the ground truth for votes()
+        X = np.asarray(X, dtype=np.float64)
+        votes = np.zeros((len(X), self.n_classes), dtype=np.int64)
+        for tree in self.trees:
+            for i, x in enumerate(X):
+                votes[i, predict_tree(tree, x)] += 1
+        return votes
+
+    def predict(self, X, workers=None):
+        return np.argmax(self.votes(X, workers), axis=1)
+
+    def importances(self, n_features):
+        # Mean decrease in Gini impurity per feature, normalized to sum to 1
+        # (the same measure as Earth Engine's explain()['importance']). Trees
+        # imported from Earth Engine or saved without gains count as zero.
+        totals = np.zeros(n_features)
+        for tree in self.trees:
+            stack = [tree]
+            while stack:
+                node = stack.pop()
+                if not node.is_leaf():
+                    totals[node.feature] += node.gain
+                    stack.extend([node.left, node.right])
+        total = totals.sum()
+        return (totals / total if total > 0 else totals).tolist()
+
+    @classmethod
+    def from_trees(cls, trees, n_classes, **params):
+        model = cls(len(trees), **params)
+        model.n_classes = n_classes
+        model.trees = list(trees)
+        return model
+
+    def to_dict(self):
+        return {
+            'numtrees': self.numtrees,
+            'variables_per_split': self.variables_per_split,
+            'bag_fraction': self.bag_fraction,
+            'min_leaf': self.min_leaf,
+            'seed': self.seed,
+            'n_classes': self.n_classes,
+            'trees': [tree_to_list(tree) for tree in self.trees],
+        }
+
+    @classmethod
+    def from_dict(cls, payload):
+        model = cls(payload['numtrees'], payload['variables_per_split'], payload['bag_fraction'], payload['min_leaf'], payload['seed'])
+        model.n_classes = payload['n_classes']
+        model.trees = [tree_from_list(rows) for rows in payload['trees']]
+        return model
+
+
+def tree_to_list(tree):
+    # Flat [feature, threshold, left, right, label, gain] rows, root first
+    rows, stack = [], [(tree, None, None)]
+    while stack:
+        node, parent, side = stack.pop()
+        index = len(rows)
+        rows.append([node.feature, node.threshold, -1, -1, node.label, node.gain])
+        if parent is not None:
+            rows[parent][side] = index
+        if not node.is_leaf():
+            stack.append((node.right, index, 3))
+            stack.append((node.left, index, 2))
+    return rows
+
+
+def tree_from_list(rows):
+    # Rows written before gains were recorded have five columns
+    nodes = [Node(label=int(row[4]), feature=int(row[0]), threshold=float(row[1]), gain=float(row[5]) if len(row) > 5 else 0.0)
+             for row in rows]
+    for node, (_, _, left, right) in zip(nodes, (row[:4] for row in rows)):
+        if left >= 0:
+            node.left = nodes[left]
+            node.right = nodes[right]
+    return nodes[0]
+
+
+# One line of an Earth Engine (SMILE) tree from Classifier.explain()['trees'],
+# e.g. "  4) NDVI<=0.2150 120 35 1 (0.2 0.7 0.1) *"
+TREE_LINE = re.compile(r'^\s*(\d+)\)\s+(root|(\S+?)(<=|>=|<|>)(\S+))\s+(\S+)\s+(\S+)\s+(\S+)(.*)$')
+
+
+def parse_ee_tree(text, bands):
+    # Rows in the tree_to_list layout for one Earth Engine tree string. Node k's
+    # children are 2k and 2k+1; the child whose condition is < or <= becomes
+    # the left one, and strict comparisons are turned into <= on the next
+    # smaller float so routing stays exact.
+    nodes = {}
+    for line in text.splitlines():
+        match = TREE_LINE.match(line)
+        if not match:
+            continue
+        number, _, band, op, value, _, _, label, rest = match.groups()
+        nodes[int(number)] = {'band': band, 'op': op, 'value': value,
+                              'label': int(round(float(label))), 'leaf': rest.strip().endswith('*')}
+    if 1 not in nodes:
+        raise ValueError("Not an Earth Engine tree string (no root node)")
+
+    # Preorder with the low child first, the same row order as tree_to_list
+    rows, index, links = [], {}, []
+    stack = [1]
+    while stack:
+        number = stack.pop()
+        node = nodes[number]
+        index[number] = len(rows)
+        rows.append([-1, 0.0, -1, -1, node['label']])
+        if node['leaf']:
+            continue
+        low = 2 * number if nodes[2 * number]['op'] in ('<', '<=') else 2 * number + 1
+        high = 4 * number + 1 - low
+        condition = nodes[low]
+        if condition['band'] not in bands:
+            raise ValueError(f"Tree splits on {condition['band']}, which is not one of the model bands")
+        threshold = float(condition['value'])
+        if condition['op'] == '<':
+            threshold = float(np.nextafter(threshold, -np.inf))
+        rows[-1][0] = bands.index(condition['band'])
+        rows[-1][1] = threshold
+        links.append((number, low, high))
+        stack.append(high)
+        stack.append(low)
+
+    for number, low, high in links:
+        rows[index[number]][2] = index[low]
+        rows[index[number]][3] = index[high]
+    return rows
+
+
+def forest_from_ee(tree_strings, bands, n_classes=None):
+    # Local RandomForest from the trees of an Earth Engine classifier artifact
+    trees = [tree_from_list(parse_ee_tree(text, list(bands))) for text in tree_strings]
+    if n_classes is None:
+        n_classes = max(label for tree in trees for label in forest_labels(tree)) + 1
+    return RandomForest.from_trees(trees, n_classes)
+
+
+def matches_reference(model, X, workers=None):
+    # Exact comparison of the compiled votes against the tree-by-tree walk
+    return np.array_equal(model.votes(X, workers), model.reference_votes(X))
+
+
+def forest_labels(tree):
+    # Every label that appears in a tree
+    labels, stack = set(), [tree]
+    while stack:
+        node = stack.pop()
+        labels.add(node.label)
+        if not node.is_leaf():
+            stack.extend([node.left, node.right])
+    return labels
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import builtins
+import importlib
+import threading
+
+# Deferred module imports plus an opt-in import profiler.
+#   gpd = lazy_import('geopandas')   # imported on first attribute access
+# Set TNC_PROFILE_IMPORTS=1 (or run `python -m app.lazy <module>...`) to record
+# how long each module takes to import.
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    self._module = importlib.import_module(self._name)
+                    lazy_timings[self._name] = time.perf_counter() - start
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+lazy_timings = {}
+import_timings = {}
+_original_import = builtins.__import__
+_import_depth = threading.local()
+
+
+def lazy_import(name):
+    # Already imported modules are returned as-is
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def is_loaded(module):
+    return not isinstance(module, LazyModule) or module._module is not None
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # Time first imports only; nested imports are included in their parent's time
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    depth = getattr(_import_depth, 'value', 0)
+    _import_depth.value = depth + 1
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _import_depth.value = depth
+        elapsed = time.perf_counter() - start
+        if name not in import_timings:
+            import_timings[name] = {'seconds': elapsed, 'depth': depth}
+
+
+def enable_profiling():
+    builtins.__import__ = _profiled_import
+
+
+def disable_profiling():
+    builtins.__import__ = _original_import
+
+
+def import_report(top=25, max_depth=0):
+    # Slowest imports (top-level only by default) plus anything loaded lazily
+    rows = [(name, info['seconds']) for name, info in import_timings.items() if info['depth'] <= max_depth]
+    rows += [(f'{name} (lazy)', seconds) for name, seconds in lazy_timings.items()]
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return rows[:top]
+
+
+def print_import_report(top=25, file=None):
+    for name, seconds in import_report(top):
+        print(f"IMPORT: {seconds * 1000:9.1f} ms  {name}", file=file)
+
+
+if os.environ.get('TNC_PROFILE_IMPORTS'):
+    enable_profiling()
+
+
+if __name__ == '__main__':
+    # Profile through the importable module so lazy timings land in the same place
+    from app import lazy as profiler
+    profiler.enable_profiling()
+    for module in sys.argv[1:] or ['app.fnc']:
+        builtins.__import__(module)
+    profiler.print_import_report()
@@ -0,0 +1,97 @@
+import json
+import time
+import threading
+
+from app.lazy import lazy_import
+
+ee = lazy_import('ee')
+st = lazy_import('streamlit')
+
+# Process-wide Earth Engine session: credentials are parsed and ee.Initialize
+# runs once per process instead of on every Streamlit rerun. app.fnc and
+# app.backend reach Earth Engine through `client`, so a stand-in set with
+# set_client (e.g. the recording fake in benchmarks/) replaces the ee module
+# for the whole pipeline.
+
+
+class Client:
+    # Forwards to the injected stand-in, or to the ee module when none is set
+    def __init__(self):
+        self.target = None
+
+    def __getattr__(self, attr):
+        return getattr(self.target if self.target is not None else ee, attr)
+
+    def __repr__(self):
+        return f"<ee client ({'stand-in' if self.target is not None else 'ee'})>"
+
+
+class EESession:
+    def __init__(self):
+        self.client = Client()
+        self.initialized_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self):
+        return self.initialized_at is not None
+
+    def initialize(self, secrets=None):
+        with self._lock:
+            if self.initialized:
+                return self.client
+
+            # A stand-in needs no credentials
+            if self.client.target is None:
+                secrets = st.secrets if secrets is None else secrets
+                key_data = json.dumps(json.loads(secrets['data-service-account'], strict=False))
+                credentials = ee.ServiceAccountCredentials(secrets['service_account'], key_data=key_data)
+                ee.Initialize(credentials)
+
+            self.initialized_at = time.time()
+            return self.client
+
+    def set_client(self, client):
+        # Route every later Earth Engine call to client (None restores the ee module)
+        with self._lock:
+            self.client.target = client
+            self.initialized_at = None
+        return self.client
+
+    def health(self):
+        # One tiny round trip to check the session still works
+        if not self.initialized:
+            return {'ok': False, 'initialized': False, 'error': 'not initialized'}
+        start = time.perf_counter()
+        try:
+            ok = self.client.Number(1).getInfo() == 1
+            error = None
+        except Exception as e:
+            ok, error = False, str(e)
+        return {
+            'ok': ok,
+            'initialized': True,
+            'initialized_at': self.initialized_at,
+            'latency': time.perf_counter() - start,
+            'error': error,
+        }
+
+
+_session = EESession()
+client = _session.client
+
+
+def get_session():
+    return _session
+
+
+def initialize(secrets=None):
+    return get_session().initialize(secrets)
+
+
+def set_client(client):
+    return get_session().set_client(client)
+
+
+def health():
+    return get_session().health()
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import shutil
+import bisect
+import threading
+
+import numpy as np
+
+# Chunked, memory-mapped band store for the local backend's Sentinel-2 scenes.
+# Each scene is ingested once from its .npz/.tif source into one .npy file per
+# band, laid out as (chunk rows, chunk cols, CHUNK, CHUNK) so that every chunk
+# is one contiguous block. Reads memory-map the band files and copy only the
+# chunks a pixel window touches, so computing indices for a county or sampling
+# a few point clusters never loads whole multi-band rasters into RAM.
+#   <root>/<collection id>/index.json           scene catalog (date, cloud cover, grid, bands, size, last use)
+#   <root>/<collection id>/<scene>/<band>.npy   chunked band
+# The catalog is sorted by date and answers query() without opening any scene.
+# Once the stored bands exceed max_bytes (TNC_STORE_MAX_MB, default 4096; 0
+# turns the store off) the least recently used scenes are evicted, and they
+# are re-ingested from their source the next time they are read.
+
+CHUNK = 256
+STORE_MAX_BYTES = int(float(os.environ.get('TNC_STORE_MAX_MB', '4096')) * 2 ** 20)
+
+
+def header_bounds(header):
+    x0, dx, y0, dy = header['transform']
+    height, width = header['shape']
+    return (x0, y0 + height * dy, x0 + width * dx, y0)
+
+
+def overlaps(a, b):
+    return not (a[2] < b[0] or a[0] > b[2] or a[3] < b[1] or a[1] > b[3])
+
+
+def bounds_window(header, bounds):
+    # Pixel window (row0, row1, col0, col1) of the scene grid that covers bounds,
+    # or None when they do not overlap
+    x0, dx, y0, dy = header['transform']
+    height, width = header['shape']
+    xmin, ymin, xmax, ymax = bounds
+    col0 = max(int(np.floor((xmin - x0) / dx)), 0)
+    col1 = min(int(np.ceil((xmax - x0) / dx)), width)
+    row0 = max(int(np.floor((ymax - y0) / dy)), 0)
+    row1 = min(int(np.ceil((ymin - y0) / dy)), height)
+    if row0 >= row1 or col0 >= col1:
+        return None
+    return row0, row1, col0, col1
+
+
+def window_transform(header, window):
+    x0, dx, y0, dy = header['transform']
+    row0, _, col0, _ = window
+    return (x0 + col0 * dx, dx, y0 + row0 * dy, dy)
+
+
+def filter_headers(headers, dates, start, end, cloud=None, bounds=None):
+    # Scenes in [start, end) under the cloud limit that overlap bounds; headers
+    # are sorted by date and dates is the matching list of 'YYYY-MM-DD' strings
+    first, last = bisect.bisect_left(dates, start), bisect.bisect_left(dates, end)
+    return [
+        header for header in headers[first:last]
+        if (cloud is None or header['cloudy'] < cloud) and (bounds is None or overlaps(header_bounds(header), bounds))
+    ]
+
+
+def scene_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class BandStore:
+    def __init__(self, root, max_bytes=STORE_MAX_BYTES, chunk=CHUNK):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.chunk = chunk
+        self.chunks_read = 0
+        self.ingested = 0
+        self.evicted = 0
+        self._indexes = {}
+        self._catalogs = {}
+        self._lock = threading.RLock()
+        # One lock per scene being ingested, so only that scene's readers wait
+        self._ingest_locks = {}
+
+    def _folder(self, collection_id, name=None):
+        folder = os.path.join(self.root, *collection_id.split('/'))
+        return os.path.join(folder, name) if name else folder
+
+    def _index(self, collection_id):
+        # Loaded once per process; a store written with another chunk size starts over
+        if collection_id not in self._indexes:
+            path = os.path.join(self._folder(collection_id), 'index.json')
+            index = {'chunk': self.chunk, 'scenes': {}}
+            if os.path.exists(path):
+                with open(path) as f:
+                    saved = json.load(f)
+                if saved.get('chunk') == self.chunk:
+                    index = saved
+                    for entry in index['scenes'].values():
+                        entry['shape'], entry['transform'] = tuple(entry['shape']), tuple(entry['transform'])
+                else:
+                    shutil.rmtree(self._folder(collection_id), ignore_errors=True)
+            self._indexes[collection_id] = index
+        return self._indexes[collection_id]
+
+    def _save(self, collection_id):
+        folder = self._folder(collection_id)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self._index(collection_id), f)
+        os.replace(path + '.tmp', path)
+
+    def _drop(self, collection_id, name):
+        entry = self._index(collection_id)['scenes'][name]
+        shutil.rmtree(self._folder(collection_id, name), ignore_errors=True)
+        entry.update(stored=False, bytes=0)
+
+    def catalog(self, collection_id, paths, read_header):
+        # Headers of the source scenes sorted by date. Only new or changed
+        # sources are opened, and read_header(path) reads just their metadata.
+        # The sources are re-stat'ed on every call, so a scene rewritten in
+        # place is re-read (and re-ingested) instead of served stale.
+        sources = []
+        for path in paths:
+            stat = os.stat(path)
+            sources.append([path, stat.st_mtime_ns, stat.st_size])
+        with self._lock:
+            cached = self._catalogs.get(collection_id)
+            if cached and cached[0] == sources:
+                return cached[1]
+
+            index = self._index(collection_id)
+            scenes, changed = {}, False
+            for source in sources:
+                path = source[0]
+                name = scene_name(path)
+                entry = index['scenes'].get(name)
+                if entry is None or entry['source'] != source:
+                    if entry is not None:
+                        self._drop(collection_id, name)
+                    entry = {**read_header(path), 'collection': collection_id, 'name': name,
+                             'source': source, 'stored': False, 'bytes': 0, 'used': 0}
+                    changed = True
+                scenes[name] = entry
+            for name in set(index['scenes']) - set(scenes):
+                # The source is gone, so its chunks are too
+                self._drop(collection_id, name)
+                changed = True
+            index['scenes'] = scenes
+            if changed:
+                self._save(collection_id)
+            # The cap may have shrunk since the store was written
+            self.evict()
+
+            headers = sorted(scenes.values(), key=lambda entry: (entry['date'], entry['name']))
+            self._catalogs[collection_id] = (sources, headers, [header['date'] for header in headers])
+            return headers
+
+    def query(self, collection_id, paths, read_header, start, end, cloud=None, bounds=None):
+        # Temporal lookup by bisection on the date-sorted catalog, then the cloud and bbox filters
+        self.catalog(collection_id, paths, read_header)
+        _, headers, dates = self._catalogs[collection_id]
+        return filter_headers(headers, dates, start, end, cloud, bounds)
+
+    def _ingest(self, entry, load):
+        # Rewrite every band of the source as a chunked .npy in a private folder
+        # without holding the store lock; only the swap and the index update are
+        # done under it
+        collection_id, name = entry['collection'], entry['name']
+        scene = load(entry['path'])
+        folder = self._folder(collection_id, name)
+        tmp = f'{folder}.tmp-{os.getpid()}-{threading.get_ident()}'
+        os.makedirs(tmp, exist_ok=True)
+
+        size = self.chunk
+        height, width = entry['shape']
+        rows, cols = -(-height // size), -(-width // size)
+        total = 0
+        for band, data in zip(scene['bands'], scene['data']):
+            path = os.path.join(tmp, f'{band}.npy')
+            padded = np.zeros((rows * size, cols * size), dtype=data.dtype)
+            padded[:height, :width] = data
+            chunks = np.lib.format.open_memmap(path, mode='w+', dtype=data.dtype, shape=(rows, cols, size, size))
+            chunks[...] = padded.reshape(rows, size, cols, size).swapaxes(1, 2)
+            chunks.flush()
+            del chunks
+            total += os.path.getsize(path)
+
+        with self._lock:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(tmp, folder)
+            entry.update(stored=True, bytes=total)
+            self.ingested += 1
+            self._save(collection_id)
+            self.evict(keep=[(collection_id, name)])
+
+    def _open(self, entry, bands, load):
+        # Memory maps of the bands, ingesting the scene first if needed. The
+        # maps are opened under the store lock, so a concurrent eviction cannot
+        # remove the files first (and if it already did, the scene is ingested
+        # again).
+        key = (entry['collection'], entry['name'])
+        with self._lock:
+            ingest_lock = self._ingest_locks.setdefault(key, threading.Lock())
+        while True:
+            with ingest_lock:
+                if not entry['stored']:
+                    self._ingest(entry, load)
+            with self._lock:
+                if entry['stored']:
+                    entry['used'] = time.time()
+                    folder = self._folder(*key)
+                    return {band: np.load(os.path.join(folder, f'{band}.npy'), mmap_mode='r') for band in bands}
+
+    def _chunks(self, window, parts):
+        # Chunk (row, col) indices under any part of the window
+        size = self.chunk
+        touched = set()
+        for row0, row1, col0, col1 in parts or [window]:
+            for i in range(row0 // size, (row1 - 1) // size + 1):
+                for j in range(col0 // size, (col1 - 1) // size + 1):
+                    touched.add((i, j))
+        return sorted(touched)
+
+    def read(self, entry, bands, window=None, parts=None, load=None):
+        # {band: array} for the pixel window (row0, row1, col0, col1), by default
+        # the whole scene. With parts (pixel windows inside it) only the chunks
+        # under some part are copied; the rest of the window stays zero.
+        # load(path) returns the source scene (see backend.read_scene) if it has
+        # to be ingested.
+        height, width = entry['shape']
+        row0, row1, col0, col1 = window or (0, height, 0, width)
+        arrays = self._open(entry, bands, load)
+        chunks = self._chunks((row0, row1, col0, col1), parts)
+
+        size = self.chunk
+        out = {}
+        for band, array in arrays.items():
+            data = np.zeros((row1 - row0, col1 - col0), dtype=array.dtype)
+            for i, j in chunks:
+                top, bottom = max(i * size, row0), min((i + 1) * size, row1)
+                left, right = max(j * size, col0), min((j + 1) * size, col1)
+                data[top - row0:bottom - row0, left - col0:right - col0] = \
+                    array[i, j, top - i * size:bottom - i * size, left - j * size:right - j * size]
+            out[band] = data
+        self.chunks_read += len(chunks) * len(arrays)
+        return out
+
+    def usage(self):
+        with self._lock:
+            entries = [entry for index in self._indexes.values() for entry in index['scenes'].values()]
+            return {
+                'bytes': sum(entry['bytes'] for entry in entries),
+                'scenes': sum(entry['stored'] for entry in entries),
+                'chunks_read': self.chunks_read,
+                'ingested': self.ingested,
+                'evicted': self.evicted,
+            }
+
+    def evict(self, keep=()):
+        # Least recently used scenes go first until the stored bands fit in
+        # max_bytes (across the collections this process has opened)
+        with self._lock:
+            stored = sorted(
+                (entry['used'], collection_id, name)
+                for collection_id, index in self._indexes.items()
+                for name, entry in index['scenes'].items()
+                if entry['stored'] and (collection_id, name) not in keep
+            )
+            total = self.usage()['bytes']
+            touched = set()
+            for _, collection_id, name in stored:
+                if total <= self.max_bytes:
+                    break
+                total -= self._index(collection_id)['scenes'][name]['bytes']
+                self._drop(collection_id, name)
+                self.evicted += 1
+                touched.add(collection_id)
+            for collection_id in touched:
+                self._save(collection_id)
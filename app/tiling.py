@@ -0,0 +1,83 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from app.fnc import span
+from app.concurrency import request
+
+# Tiled county classification: the ROI is cut into a grid of tiles that are
+# classified concurrently and written into one mosaic as they finish. Each tile
+# request takes a process-wide request slot, so the tiles of all jobs together
+# stay under TNC_MAX_CONCURRENCY.
+
+# Nominal EPSG:4326 pixel size Earth Engine uses for a scale in metres
+DEGREES_PER_METER = 1 / 111319.49079327357
+
+
+class Grid:
+    # Regular lon/lat grid anchored at the upper-left corner of the bounds
+    def __init__(self, bounds, scale=30):
+        xmin, ymin, xmax, ymax = bounds
+        self.step = scale * DEGREES_PER_METER
+        self.x0 = xmin
+        self.y0 = ymax
+        self.width = max(1, int(np.ceil((xmax - xmin) / self.step)))
+        self.height = max(1, int(np.ceil((ymax - ymin) / self.step)))
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    @property
+    def transform(self):
+        return (self.x0, self.step, self.y0, -self.step)
+
+    def tiles(self, tile_pixels=512):
+        # (row, col, height, width) windows covering the grid
+        return [
+            (row, col, min(tile_pixels, self.height - row), min(tile_pixels, self.width - col))
+            for row in range(0, self.height, tile_pixels)
+            for col in range(0, self.width, tile_pixels)
+        ]
+
+    def tile_bounds(self, tile):
+        row, col, height, width = tile
+        xmin = self.x0 + col * self.step
+        ymax = self.y0 - row * self.step
+        return (xmin, ymax - height * self.step, xmin + width * self.step, ymax)
+
+
+def classify_tiled(backend, image, model, bands, roi, scale=30, tile_pixels=512, max_workers=4,
+                   retries=3, backoff=1.0, on_progress=None, on_tile=None):
+    # Classify every tile on a bounded thread pool. Finished tiles are written
+    # into the mosaic (and passed to on_tile) as soon as they arrive. Tiles are
+    # retried on rate-limit errors only; tiles that still fail are returned so
+    # the caller can report them.
+    grid = Grid(backend.bounds(roi), scale)
+    tiles = grid.tiles(tile_pixels)
+    mosaic = np.full(grid.shape, np.nan, dtype=np.float32)
+    failed = []
+
+    def run(tile):
+        bounds = grid.tile_bounds(tile)
+        return request(lambda: backend.classify_tile(image, model, bands, bounds, tile[2:], grid.step), retries, backoff)
+
+    # Workers run in a copy of the caller's context so their spans land on the caller's timer
+    with span('classification', tiles=len(tiles)), ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(contextvars.copy_context().run, run, tile): tile for tile in tiles}
+        for done, future in enumerate(as_completed(futures), start=1):
+            tile = futures[future]
+            row, col, height, width = tile
+            try:
+                values = future.result()
+            except Exception as e:
+                failed.append((tile, e))
+            else:
+                mosaic[row:row + height, col:col + width] = values
+                if on_tile:
+                    on_tile(tile, values)
+            if on_progress:
+                on_progress(done, len(tiles))
+
+    return mosaic, grid, failed
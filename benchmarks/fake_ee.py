@@ -0,0 +1,119 @@
+import sys
+import json
+import types
+
+# Recording stand-in for the earthengine-api module. Every call builds a node
+# in an expression graph, as with the real client, and nothing is computed.
+# getInfo serializes the graph (shared nodes once, mapped functions traced with
+# a placeholder argument) and records it as one round trip.
+#   client = install()   # also the session client, so app.fnc / app.backend use it
+#   client.recorder.calls, client.recorder.request_bytes
+
+
+class Recorder:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = []
+
+    @property
+    def round_trips(self):
+        return len(self.calls)
+
+    @property
+    def request_bytes(self):
+        return sum(size for _, size in self.calls)
+
+    def record(self, node):
+        size = len(serialize(node))
+        self.calls.append((node.name, size))
+        return size
+
+
+class Node:
+    def __init__(self, recorder, name, args=(), kwargs=None):
+        self._recorder = recorder
+        self.name = name
+        self.args = list(args)
+        self.kwargs = dict(kwargs or {})
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return lambda *args, **kwargs: Node(self._recorder, attr, [self] + list(args), kwargs)
+
+    def serialize(self):
+        return serialize(self)
+
+    def getInfo(self):
+        self._recorder.record(self)
+        return resolve(self)
+
+
+class Namespace:
+    # ee.Geometry, ee.Geometry.Rectangle, ee.Classifier.smileRandomForest, ...
+    def __init__(self, recorder, name):
+        self._recorder = recorder
+        self._name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return Namespace(self._recorder, f'{self._name}.{attr}')
+
+    def __call__(self, *args, **kwargs):
+        return Node(self._recorder, self._name, args, kwargs)
+
+
+def serialize(node):
+    # Compact JSON with one entry per distinct node, like the real client's scope
+    values, ids = [], {}
+
+    def encode(value):
+        if isinstance(value, Node):
+            if id(value) not in ids:
+                encoded = {
+                    'name': value.name,
+                    'args': [encode(arg) for arg in value.args],
+                    'kwargs': {key: encode(arg) for key, arg in sorted(value.kwargs.items())},
+                }
+                ids[id(value)] = len(values)
+                values.append(encoded)
+            return {'ref': ids[id(value)]}
+        if callable(value):
+            return {'function': encode(value(Node(node._recorder, 'argument')))}
+        if isinstance(value, dict):
+            return {str(key): encode(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(item) for item in value]
+        if hasattr(value, 'item'):
+            return value.item()
+        return value
+
+    result = encode(node)
+    return json.dumps({'result': result, 'values': values}, separators=(',', ':'))
+
+
+def resolve(node):
+    # Placeholder values with the right shape for the calls the app makes
+    if node.name == 'Dictionary' and node.args and isinstance(node.args[0], dict):
+        return {key: 0 for key in node.args[0]}
+    if node.name == 'List' and node.args and isinstance(node.args[0], (list, tuple)):
+        return [resolve(item) if isinstance(item, Node) else item for item in node.args[0]]
+    if node.name in ('size', 'Number'):
+        return 0
+    return None
+
+
+def install(name='ee'):
+    recorder = Recorder()
+    module = types.ModuleType(name)
+    module.__getattr__ = lambda attr: Namespace(recorder, attr)
+    module.recorder = recorder
+    module.Initialize = lambda *args, **kwargs: None
+    sys.modules[name] = module
+    # The pipeline reaches ee through the session client
+    from app import session
+    session.set_client(module)
+    return module
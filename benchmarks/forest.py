@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import argparse
+import json
+import tempfile
+
+import numpy as np
+
+import app.fnc as fnc
+from app.backend import get_backend
+from app.forest import RandomForest, matches_reference, parse_ee_tree, forest_from_ee
+
+# Compiled (FlatForest) against tree-by-tree random forest prediction. The
+# forest is trained on the bundled data/ labels sampled with the local backend
+# (TNC_LOCAL_DATA), the compiled votes must equal the reference votes exactly on
+# that training table, and throughput is measured on a larger block of pixels.
+#   python -m benchmarks.forest                       # bundled CSVs, 50 trees
+#   python -m benchmarks.forest --csv SantaMaria --pixels 2000000 --workers 4
+#   python -m benchmarks.forest --synthetic           # no scene data needed
+# It also parses a recorded Earth Engine tree and loads it as a local model.
+# Exits with status 1 if the votes differ or the recorded tree routes wrongly.
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+BANDS = list(fnc.DEFAULT_BANDS)
+CLASS_MAPPING = {'hoop': 0, 'mulch': 1, 'other': 2, 'green house': 3}
+
+# One tree of smileRandomForest(...).explain()['trees'], in the SMILE text
+# layout Earth Engine returns (node number, split, n, deviance, yval, (yprob))
+EE_TREE = """n= 1203
+node), split, n, deviance, yval, (yprob)
+      * denotes terminal node
+
+ 1) root 1203 2364.1770 2 (0.2294 0.2594 0.5112)
+   2) NDVI<=0.31417500972747803 612 1027.4030 1 (0.4003 0.4935 0.1062)
+     4) B11<=0.23150000721216202 301 412.8812 0 (0.7143 0.2458 0.0399) *
+     5) B11>0.23150000721216202 311 377.0514 1 (0.0965 0.7331 0.1704)
+      10) PMLI<=-0.10850000008940697 140 120.3301 1 (0.0500 0.9000 0.0500) *
+      11) PMLI>-0.10850000008940697 171 210.8877 2 (0.1345 0.2965 0.5690) *
+   3) NDVI>0.31417500972747803 591 402.9021 2 (0.0525 0.0169 0.9306) *
+"""
+# (NDVI, B11, PMLI) and the leaf label each row must reach; the first row sits
+# exactly on the root threshold, which goes left like the <= condition
+EE_TREE_ROUTES = [
+    ((0.31417500972747803, 0.1, 0.0), 0),
+    ((0.2, 0.3, -0.2), 1),
+    ((0.2, 0.3, 0.0), 2),
+    ((0.2, 0.23150000721216202, 0.5), 0),
+    ((0.5, 0.1, -0.5), 2),
+]
+
+
+def training_table(csv_filenames):
+    # Same sampling as the pages, run on the local backend
+    backend = get_backend('local')
+    csv_data, _ = fnc.load_data(DATA_PATH, csv_filenames, [], backend)
+    table = backend.merge(fnc.create_fc_csv(csv_data, csv_filenames, CLASS_MAPPING, BANDS, backend))
+    return table[BANDS].to_numpy(), table['class'].to_numpy()
+
+
+def synthetic_table(rows=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(rows, len(BANDS)))
+    y = (X[:, 0] + X[:, 4] > 0).astype(np.int64) + 2 * (X[:, 7] > 1)
+    return X, y
+
+
+def ee_tree_check():
+    # The recorded tree parses into the expected table, routes like Earth Engine,
+    # and the local backend loads it from an Earth Engine artifact
+    rows = parse_ee_tree(EE_TREE, BANDS)
+    X = np.zeros((len(EE_TREE_ROUTES), len(BANDS)))
+    for i, ((ndvi, b11, pmli), _) in enumerate(EE_TREE_ROUTES):
+        X[i, [BANDS.index('NDVI'), BANDS.index('B11'), BANDS.index('PMLI')]] = ndvi, b11, pmli
+    expected = [label for _, label in EE_TREE_ROUTES]
+    routed = forest_from_ee([EE_TREE], BANDS).predict(X, workers=1).tolist() == expected
+
+    key = 'e' * 64
+    with tempfile.TemporaryDirectory() as model_dir:
+        artifact = {'version': fnc.MODEL_VERSION, 'key': key, 'backend': 'ee', 'metrics': {},
+                    'model': {'trees': [EE_TREE], 'bands': BANDS}}
+        with open(os.path.join(model_dir, f'pretrained-ee-{key[:16]}.json'), 'w') as f:
+            json.dump(artifact, f)
+
+        def train():
+            raise AssertionError("the Earth Engine artifact should have been used")
+
+        model, _ = fnc.get_pretrained_model(key, train, get_backend('local'), model_dir)
+        fnc.pretrained_models.pop(('local', key), None)
+    loaded = model.predict(X, workers=1).tolist() == expected
+    return len(rows), routed and loaded
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check and time compiled random forest prediction.")
+    parser.add_argument('--csv', default='Mendocino,SantaMaria,Watsonville', help="Bundled CSVs to train on")
+    parser.add_argument('--synthetic', action='store_true', help="Train on a synthetic table instead")
+    parser.add_argument('--numtrees', type=int, default=50)
+    parser.add_argument('--pixels', type=int, default=1000000, help="Pixels in the throughput block")
+    parser.add_argument('--workers', type=int, default=None, help="Prediction threads (default TNC_PREDICT_WORKERS)")
+    args = parser.parse_args(argv)
+
+    nodes, tree_ok = ee_tree_check()
+    print(f"EE TREE: {nodes} nodes parsed; routing {'matches' if tree_ok else 'DIFFERS'}")
+
+    if args.synthetic:
+        X, y = synthetic_table()
+    else:
+        X, y = training_table([name for name in args.csv.split(',') if name])
+    model, fit_seconds = timed(lambda: RandomForest(args.numtrees).fit(X, y))
+    flat, compile_seconds = timed(model.compiled)
+    print(f"FOREST: {args.numtrees} trees, {len(flat.label)} nodes ({flat.nbytes / 2 ** 20:.1f} MiB) "
+          f"from {len(X)} rows; fit {fit_seconds:.2f} s, compile {compile_seconds * 1000:.1f} ms")
+    ranked = sorted(zip(BANDS, model.importances(len(BANDS))), key=lambda item: -item[1])
+    print(f"IMPORTANCE: {', '.join(f'{band} {share:.1%}' for band, share in ranked)}")
+
+    same = matches_reference(model, X, args.workers)
+    reference, reference_seconds = timed(lambda: model.reference_votes(X))
+    _, compiled_seconds = timed(lambda: model.votes(X, args.workers))
+    print(f"TRAINING ROWS: votes {'match' if same else 'DIFFER'}; reference {reference_seconds:.3f} s, "
+          f"compiled {compiled_seconds:.3f} s")
+
+    # Training rows with a little noise, so the block follows the real feature distribution
+    rng = np.random.default_rng(0)
+    block = X[rng.integers(0, len(X), args.pixels)] * rng.normal(1, 0.01, size=(args.pixels, X.shape[1]))
+    _, block_seconds = timed(lambda: model.predict(block, args.workers))
+    per_pixel = reference_seconds / len(X)
+    print(f"BLOCK: {args.pixels} pixels in {block_seconds:.2f} s ({args.pixels / block_seconds:,.0f} px/s); "
+          f"the reference would take about {per_pixel * args.pixels:.0f} s")
+    return 0 if same and tree_ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from benchmarks import fake_ee
+
+# Benchmarks for the fnc pipeline on the bundled data/ files against the
+# recording fake ee module. Each stage reports wall time, getInfo round trips,
+# serialized request bytes and peak traced memory, and is compared with
+# benchmarks/baseline.json. Any regression makes the run exit with status 1.
+#   python -m benchmarks.run              # compare with the baseline
+#   python -m benchmarks.run --update     # write a new baseline
+
+client = fake_ee.install()
+# Label caches go to a scratch folder that is removed when the run exits
+if 'TNC_CACHE_DIR' not in os.environ:
+    cache_dir = tempfile.TemporaryDirectory(prefix='tnc-bench-')
+    os.environ['TNC_CACHE_DIR'] = cache_dir.name
+# The fake client does no I/O, so threads would only measure GIL contention
+os.environ.setdefault('TNC_MAX_CONCURRENCY', '1')
+
+import app.fnc as fnc
+from app.backend import EEBackend
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# Same inputs as the pretrained page
+BANDS = fnc.DEFAULT_BANDS
+CLASS_MAPPING = {'hoop': 0, 'mulch': 1, 'other': 2, 'green house': 3}
+CSV_FILENAMES = ['Mendocino', 'SantaMaria', 'Watsonville']
+SHAPE_FILENAMES = [['Oxnard', 'label_mulch_hoop', 'label_nonplastic']]
+SHAPE_DATES = [['2019-02-01', '2019-06-01']]
+
+# Allowed growth over the baseline before a metric counts as a regression
+TOLERANCES = {'getinfo_calls': 0.0, 'request_bytes': 0.05, 'peak_memory': 0.25, 'wall_time': 0.5}
+# Plus a fixed allowance so scheduler noise on millisecond stages is not a regression
+SLACK = {'wall_time': 0.05}
+
+
+def fresh_csv_data():
+    # processData adds NumericType to its input, so every run gets new frames
+    return [fnc.read_labels(os.path.join(DATA_PATH, f'{name}.csv'))[0] for name in CSV_FILENAMES]
+
+
+def resolve(fcs):
+    # Send the collections the way training would, in one round trip
+    return fnc.get_sample_counts({str(i): fc for i, fc in enumerate(fcs)})
+
+
+def stage_load_data(backend):
+    return lambda: fnc.load_data(DATA_PATH, CSV_FILENAMES, SHAPE_FILENAMES, backend)
+
+
+def stage_process_data(backend):
+    df = fresh_csv_data()[1]
+    return lambda: resolve([fnc.processData(df.copy(), CSV_FILENAMES[1], CLASS_MAPPING, BANDS, backend)])
+
+
+def stage_create_fc_csv(backend):
+    csv_data = fresh_csv_data()
+    return lambda: resolve(fnc.create_fc_csv([df.copy() for df in csv_data], CSV_FILENAMES, CLASS_MAPPING, BANDS, backend))
+
+
+def stage_create_fc_shape(backend):
+    _, shape_data = fnc.load_data(DATA_PATH, [], SHAPE_FILENAMES, backend)
+    return lambda: resolve(fnc.create_fc_shape(shape_data, SHAPE_DATES, backend, bands=BANDS))
+
+
+def stage_get_data_as_points(backend):
+    df = fresh_csv_data()[1]
+    df['NumericType'] = fnc.encode_labels(df['Type'], CLASS_MAPPING)
+    return lambda: resolve([fnc.get_data_as_points(df)])
+
+
+STAGES = {
+    'load_data': stage_load_data,
+    'processData': stage_process_data,
+    'create_fc_csv': stage_create_fc_csv,
+    'create_fc_shape': stage_create_fc_shape,
+    'get_data_as_points': stage_get_data_as_points,
+}
+
+
+def clear_caches():
+    fnc.composite_cache.clear()
+    fnc.points_cache.clear()
+    fnc.evaluation_cache.clear()
+
+
+def measure(setup, backend, repeat=5):
+    run = setup(backend)
+
+    # Warm-up so one-off imports and the on-disk label caches are not counted
+    clear_caches()
+    run()
+
+    # Counts, bytes and memory from one traced run
+    clear_caches()
+    client.recorder.reset()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {
+        'getinfo_calls': client.recorder.round_trips,
+        'request_bytes': client.recorder.request_bytes,
+        'peak_memory': peak,
+    }
+
+    # Best of several untraced runs for wall time
+    times = []
+    for _ in range(repeat):
+        clear_caches()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    result['wall_time'] = min(times)
+    return result
+
+
+def compare(results, baseline, tolerances=TOLERANCES, slack=SLACK):
+    regressions = []
+    for stage, metrics in results.items():
+        for metric, value in metrics.items():
+            expected = baseline.get(stage, {}).get(metric)
+            if expected is None:
+                continue
+            if value > expected * (1 + tolerances[metric]) + slack.get(metric, 0):
+                regressions.append(f"{stage}.{metric}: {value:g} > baseline {expected:g} (+{tolerances[metric]:.0%})")
+    return regressions
+
+
+def print_results(results, file=None):
+    print(f"{'stage':<20} {'wall (ms)':>10} {'getInfo':>8} {'request (B)':>12} {'peak mem (KiB)':>15}", file=file)
+    for stage, metrics in results.items():
+        print(f"{stage:<20} {metrics['wall_time'] * 1000:>10.1f} {metrics['getinfo_calls']:>8} "
+              f"{metrics['request_bytes']:>12} {metrics['peak_memory'] / 1024:>15.1f}", file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the fnc pipeline against a recording fake ee module.")
+    parser.add_argument('stages', nargs='*', help=f"Stages to run (default: all of {', '.join(STAGES)})")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per stage (best is kept)")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update', action='store_true', help="Write the results as the new baseline")
+    parser.add_argument('--json', help="Also write the results to this file")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+
+    backend = EEBackend()
+    results = {name: measure(STAGES[name], backend, args.repeat) for name in args.stages or STAGES}
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.update:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
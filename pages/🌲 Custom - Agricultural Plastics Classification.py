@@ -1,16 +1,19 @@
 import datetime
-import ee
 import streamlit as st
 import geemap.foliumap as geemap
 from datetime import datetime as dt, timedelta
-import json
 import app.fnc as fnc
+import app.session as ee_session
+import app.counties as ca_counties
 
 
 # Page configuration
 st.set_page_config(layout="wide", page_title="Custom")
 st.title("Custom Model - Agricultural Plastics Classification")
 
+# Timing spans for this rerun (shown in the sidebar performance panel)
+timer = fnc.start_timer()
+
 st.sidebar.caption("""
 Source code on [GitHub](https://github.com/amelialwx/TNC-Capstone).\n
 For any issues, please contact Amelia Li at [weixili@g.harvard.edu](mailto:weixili@g.harvard.edu).
@@ -19,24 +22,15 @@ For any issues, please contact Amelia Li at [weixili@g.harvard.edu](mailto:weixi
 # Set column layout
 col1, col2 = st.columns([5, 2])
 
-# GEE authorization (Streamlit cloud)
-data_service_account = st.secrets['data-service-account']
-service_account = st.secrets['service_account']
-json_object = json.dumps(json.loads(data_service_account, strict=False))
-credentials = ee.ServiceAccountCredentials(service_account, key_data=json_object)
-ee.Initialize(credentials)
+# GEE authorization (Streamlit cloud), done once per process
+ee = ee_session.initialize()
 
 # Initialize GEE map
 Map = geemap.Map()
 Map.add_basemap("SATELLITE")
 
-# Target bands for images
-bands = [
-    # Spectrum Features
-    'B4', 'B3', 'B2', 'B6', 'B8', 'B11', 'B12',
-    # Index Features
-    'NDVI', 'NDTI', 'PGI', 'PMLI',
-]
+# Target bands for images (shared with the pretrained page and the CLI)
+bands = list(fnc.DEFAULT_BANDS)
 
 # Define class mapping
 class_mapping = {'hoop': 0, 'mulch': 1, 'other': 2, 'green house': 3}
@@ -52,11 +46,14 @@ mapping = ee.Dictionary({
 
 # Initialize session states
 if 'filenames_1' not in st.session_state:
+    st.session_state.file_keys_1 = None
     st.session_state.filenames_1 = None
     st.session_state.dfs_1 = None
     st.session_state.images_1 = None
 if 'model_1' not in st.session_state:
     st.session_state.model_1 = None
+    st.session_state.forest_1 = None
+    st.session_state.importance_1 = None
 if 'numtrees_1' not in st.session_state:
     st.session_state.numtrees_1 = 50
 if 'county_1' not in st.session_state:
@@ -64,6 +61,8 @@ if 'county_1' not in st.session_state:
 if 'start_date_1' not in st.session_state:
     st.session_state.start_date_1 = None
     st.session_state.end_date_1 = None
+if 'composite_1' not in st.session_state:
+    st.session_state.composite_1 = None
 if 'image_1' not in st.session_state:
     st.session_state.image_1 = None
 if 'classified_RF_1' not in st.session_state:
@@ -73,54 +72,56 @@ if 'layers_1' not in st.session_state:
 
 
 with col2:
-    print("===============RELOAD===============")
     # File upload prompt
     uploaded_files = st.file_uploader("Upload file(s):", accept_multiple_files=True, help=fnc.tooltip_file_uploader)
-    filenames = [file.name for file in uploaded_files]
+    # Content hashes also catch edited files that keep the same name
+    file_keys = [fnc.content_key(file.getvalue()) for file in uploaded_files]
 
-    # List of CA counties
+    # List of CA counties (bundled index, no Earth Engine calls)
     counties = ee.FeatureCollection('TIGER/2018/Counties')
-    ca_counties = counties.filter(ee.Filter.eq('STATEFP', '06'))
-    ca_counties_list = sorted(ca_counties.aggregate_array('NAME').getInfo())
+    ca_counties_list = ca_counties.county_names()
 
     # Let user pick a CA county
     option = st.selectbox('Select a California county:', ca_counties_list, index=None, placeholder="Los Angeles", help=fnc.tooltip_county)
     if not option:
-        selected_county_centroid = fnc.get_centroid_coordinates('Los Angeles', counties)
+        selected_county_centroid = ca_counties.county_centroid('Los Angeles')
     else:
-        selected_county_centroid = fnc.get_centroid_coordinates(option, counties)
+        selected_county_centroid = ca_counties.county_centroid(option)
 
     # Calculate coordinates for selected CA county, default otherwise
     longitude = selected_county_centroid[0]
     latitude = selected_county_centroid[1]
     Map.setCenter(longitude, latitude, 11)
 
-    # If this is the first session or if there is a change in the names of the uploaded files
-    if st.session_state.filenames_1 == None or st.session_state.filenames_1 != filenames:
-        st.session_state.filenames_1 = filenames
-        st.session_state.dfs_1, st.session_state.images_1 = fnc.load_data_df(uploaded_files, class_mapping, bands)
-    else:
-        print(f"No change in uploaded file names. Using previous data and images for: {st.session_state.filenames_1}")
+    # If this is the first session or if there is a change in the uploaded files
+    if st.session_state.file_keys_1 == None or st.session_state.file_keys_1 != file_keys:
+        st.session_state.file_keys_1 = file_keys
+        with fnc.span('ingestion', files=len(uploaded_files)):
+            st.session_state.filenames_1, st.session_state.dfs_1, st.session_state.images_1 = fnc.load_data_df(uploaded_files, class_mapping, bands)
+        # New training data, so start a new forest
+        st.session_state.forest_1 = None
+        st.session_state.model_1 = None
+        st.session_state.importance_1 = None
+    filenames = st.session_state.filenames_1
 
     # If files have been uploaded and processed
-    if uploaded_files: 
-        # Merge data
-        data = ee.FeatureCollection(st.session_state.images_1).flatten().randomColumn(seed=0)
+    if filenames:
+        if st.session_state.forest_1 is None:
+            # Merge data and keep it around for growing the forest
+            data = ee.FeatureCollection(st.session_state.images_1).flatten().randomColumn(seed=0)
+            st.session_state.forest_1 = fnc.WarmStartForest(data, bands)
 
         # Let the user pick the number of trees for the TF model
         numtrees = st.number_input('Number of trees:', min_value=1, max_value=100, value=st.session_state.numtrees_1, help=fnc.tooltip_numtrees)
 
         if not st.session_state.model_1:
-            # Train RF with 50 trees
-            print("MODEL: Training a default model with 50 trees...")
-            st.session_state.model_1 = fnc.train_rf(50, data, bands)
+            # Train RF with the current number of trees (50 by default)
+            st.session_state.numtrees_1 = numtrees
+            st.session_state.model_1 = st.session_state.forest_1.resize(numtrees)
         elif numtrees != st.session_state.numtrees_1:
-            # Train RF with number of trees picked by the user
-            print(f'MODEL: Training a model with {numtrees} trees...')
+            # Only the extra trees are trained; fewer trees reuse existing ones
             st.session_state.numtrees_1 = numtrees
-            st.session_state.model_1 = fnc.train_rf(st.session_state.numtrees_1, data, bands)
-        else:
-            print(f"MODEL: Using previous model with {st.session_state.numtrees_1} trees.")
+            st.session_state.model_1 = st.session_state.forest_1.resize(numtrees)
 
         # Let user pick a date range
         input_dates = st.date_input("Select date range:", [datetime.date(2020, 1, 1), datetime.date(2020, 1, 15)], help=fnc.tooltip_date_input)
@@ -135,78 +136,55 @@ with col2:
         # Format dates to strings
         start_date = start_date.strftime("%Y-%m-%d")
         end_date = end_date.strftime("%Y-%m-%d")
-        print(f'DATE: {start_date} to {end_date}')
 
-        layers = {}
+        # Let user pick how the scenes are composited
+        method = st.selectbox("Composite method:", fnc.COMPOSITE_METHODS, index=0, help=fnc.tooltip_composite)
+        percentile = 50
+        if method == 'percentile':
+            percentile = st.slider("Percentile:", min_value=5, max_value=95, value=50, step=5)
+        composite = (method, percentile)
+
+        # Ground truth points are drawn client side, so only the EE layers go in the slider
         if st.session_state.layers_1 == None:
-            print("Creating gound truth layers...")
-            # Define a dictionary of style properties per class type
-            class_styles = ee.Dictionary({
-                '0': {'color': '1e90ff', 'width': 1, 'fillColor': 'red', 'pointSize': 5, 'pointShape': 'circle'},    # hoop
-                '1': {'color': '1e90ff', 'width': 1, 'fillColor': 'green', 'pointSize': 5, 'pointShape': 'circle'},  # mulch
-                '2': {'color': '1e90ff', 'width': 1, 'fillColor': 'blue', 'pointSize': 5, 'pointShape': 'circle'},  # other
-                '3': {'color': '1e90ff', 'width': 1, 'fillColor': 'yellow', 'pointSize': 5, 'pointShape': 'circle'}   # green house
-            })
-
-            # Create ground truth layer(s) for CSV data
-            for df, filename in zip(st.session_state.dfs_1, filenames):
-                points = fnc.get_data_as_points(df)
-                points_layer = ee.FeatureCollection(points)
-
-                # Map a function over the FeatureCollection to set the style property
-                points_layer = points_layer.map(
-                    lambda feature: feature.set(
-                        'style',
-                        class_styles.get(
-                            ee.Number(feature.get('class')).format()  # Convert the class number to string to use as key
-                        )
-                    )
-                )
-
-                # Style the FeatureCollection according to each feature's 'style' property.
-                style_points_layer = points_layer.style(
-                    styleProperty='style',
-                    neighborhood=8
-                )
-
-                layers[filename] = geemap.ee_tile_layer(style_points_layer, {}, filename)
-
-            st.session_state.layers_1 = layers
-        else:
-            print("Ground truth layers already created.")
-        
+            st.session_state.layers_1 = {}
+
         # County to classify on
         county = 'Los Angeles'
         if option:
             county = option
-        # Check if the county or date range has changed
-        if (county != st.session_state.county_1) or (st.session_state.start_date_1 != start_date) or (st.session_state.end_date_1 != end_date):
+        # Check if the county, date range or composite method has changed
+        if (county != st.session_state.county_1) or (st.session_state.start_date_1 != start_date) or (st.session_state.end_date_1 != end_date) or (st.session_state.composite_1 != composite):
             selected_county = counties.filter(ee.Filter.eq('NAME', county))
             roi = selected_county.geometry()
-            processedCollection = fnc.processImageCollection(ee.ImageCollection('COPERNICUS/S2_SR'), roi, start_date, end_date)
-            image = processedCollection.median().clip(roi)
-            print(f'COUNTY: Classifying on {county}.')
+            image = fnc.get_composite('COPERNICUS/S2_SR', roi, start_date, end_date, bands=bands, method=method, percentile=percentile)
 
             # Classify
-            classified_RF = image.select(bands).classify(st.session_state.model_1)
-            accuracy_RF = st.session_state.model_1.confusionMatrix()
-            print(f"RESULTS: RF Resubstitution error matrix: {accuracy_RF.getInfo()}")
-            print(f"RESULTS: RF Training overall accuracy: {accuracy_RF.accuracy().getInfo()}")
+            with fnc.span('classification', county=county, start=start_date, end=end_date):
+                classified_RF = image.select(bands).classify(st.session_state.model_1)
+            accuracy_RF = st.session_state.forest_1.error_matrix(st.session_state.model_1)
+            # Matrix, accuracy and feature importance come back in one round trip
+            matrix_RF, overall_RF, importance_RF = fnc.evaluate(accuracy_RF, accuracy_RF.accuracy(), fnc.ee_importance(st.session_state.model_1))
+            st.session_state.importance_1 = fnc.rank_importance(importance_RF, bands)
+            print(f"RESULTS: RF Resubstitution error matrix: {matrix_RF}")
+            print(f"RESULTS: RF Training overall accuracy: {overall_RF}")
+            print(f"RESULTS: RF Feature importance: {fnc.format_importance(st.session_state.importance_1)}")
 
             # Update the session state with the current values
             st.session_state.county_1 = county
             st.session_state.start_date_1 = start_date
+            st.session_state.composite_1 = composite
             st.session_state.end_date_1 = end_date
             st.session_state.image_1 = image
             st.session_state.classified_RF_1 = classified_RF
-        else:
-            print(f'No change in county or date range. Using previous image for: {st.session_state.county_1}')
+
+        fnc.importance_panel(st.session_state.importance_1)
 
         palette = ['red', 'green', 'blue', 'yellow']
 
-        # Map slider
-        st.session_state.layers_1["Sentinel-2 RGB"] = geemap.ee_tile_layer(st.session_state.image_1.select(bands), {'min': 0, 'max': 0.3, 'gamma': 1.4}, "Sentinel-2 RGB")
-        st.session_state.layers_1["Classification"] = geemap.ee_tile_layer(st.session_state.classified_RF_1, {'min': 0, 'max': 3, 'palette': palette}, "Classification")
+        # Map slider (each new tile layer is a blocking getMapId request; repeats come from fnc.tile_cache)
+        with fnc.span('tile layers', count=2):
+            st.session_state.layers_1["Sentinel-2 RGB"] = fnc.tile_layer(st.session_state.image_1.select(bands), {'min': 0, 'max': 0.3, 'gamma': 1.4}, "Sentinel-2 RGB")
+            st.session_state.layers_1["Classification"] = fnc.tile_layer(st.session_state.classified_RF_1, {'min': 0, 'max': 3, 'palette': palette}, "Classification")
 
         options = list(st.session_state.layers_1.keys())
         left = st.selectbox("Select a left layer:", options, index=len(options) - 2, help=fnc.tooltip_left_layer)
@@ -214,6 +192,10 @@ with col2:
         left_layer = st.session_state.layers_1[left]
         right_layer = st.session_state.layers_1[right]
         Map.split_map(left_layer, right_layer)
+
+        # Ground truth layer(s) for CSV data
+        for df, filename in zip(st.session_state.dfs_1, filenames):
+            fnc.ground_truth_layer(df, filename).add_to(Map)
         
         # Add legend
         legend_titles = ['Hoop', 'Mulch', 'Other', 'Green House']
@@ -221,9 +203,12 @@ with col2:
 
 with col1:
     Map.to_streamlit(height=750)
-    if uploaded_files:
+    if filenames:
         tabs = st.tabs(filenames)
-        for df, tab, filename in zip(st.session_state.dfs_1, tabs, [file.name for file in uploaded_files]):
+        for df, tab, filename in zip(st.session_state.dfs_1, tabs, filenames):
             with tab:
                 st.write(f"Contents of the file {filename}:")
                 st.dataframe(df)
+
+fnc.session_panel()
+fnc.performance_panel(timer)
@@ -1,41 +1,34 @@
 import datetime
-import ee
 import streamlit as st
 import geemap.foliumap as geemap
 from datetime import datetime as dt, timedelta
 from functools import reduce
-import json
 import app.fnc as fnc
+import app.session as ee_session
+import app.counties as ca_counties
 
 
 # Page configuration
 st.set_page_config(layout="wide", page_title="Pretrained")
 st.title("Pretrained Model - Agricultural Plastics Classification")
 
+# Timing spans for this rerun (shown in the sidebar performance panel)
+timer = fnc.start_timer()
+
 st.sidebar.caption("""
 Source code on [GitHub](https://github.com/amelialwx/TNC-Capstone).\n
 For any issues, please contact Amelia Li at [weixili@g.harvard.edu](mailto:weixili@g.harvard.edu).
 """)
 
-# GEE authorization (Streamlit cloud)
-data_service_account = st.secrets['data-service-account']
-service_account = st.secrets['service_account']
-json_object = json.dumps(json.loads(data_service_account, strict=False))
-credentials = ee.ServiceAccountCredentials(service_account, key_data=json_object)
-ee.Initialize(credentials)
+# GEE authorization (Streamlit cloud), done once per process
+ee = ee_session.initialize()
 
 # Initialize GEE map
 Map = geemap.Map()
 Map.add_basemap("SATELLITE")
 
-# Target bands for images
-bands = [
-    # Spectrum Features
-    'B4', 'B3', 'B2', 'B6', 'B8', 'B11', 'B12',
-    # Index Features
-    'NDVI', 'NDTI', 'PGI', 'PMLI',
-    # Additional Geographical Features
-]
+# Target bands for images (shared with the custom page and the CLI)
+bands = list(fnc.DEFAULT_BANDS)
 
 # Define class mapping
 class_mapping = {'hoop': 0, 'mulch': 1, 'other': 2, 'green house': 3}
@@ -51,6 +44,7 @@ mapping = ee.Dictionary({
 # Initialize session states
 if 'model_2' not in st.session_state:
     st.session_state.model_2 = None
+    st.session_state.metrics_2 = None
 if 'csv_data_2' not in st.session_state:
     st.session_state.csv_data_2 = None
 if 'shape_data_2' not in st.session_state:
@@ -62,6 +56,8 @@ if 'county_2' not in st.session_state:
 if 'start_date_2' not in st.session_state:
     st.session_state.start_date_2 = None
     st.session_state.end_date_2 = None
+if 'composite_2' not in st.session_state:
+    st.session_state.composite_2 = None
 if 'image_2' not in st.session_state:
     st.session_state.image_2 = None
 if 'classified_RF_2' not in st.session_state:
@@ -77,45 +73,72 @@ shape_filenames = [['Oxnard', 'label_mulch_hoop', 'label_nonplastic']]
 dates = [['2019-02-01', '2019-06-01']]
 # ==============================
 
+def load_csv_data():
+    # Labels for the map and the tables (read from the Parquet cache after the first time).
+    # The classes are encoded here, since train() and its processData calls are
+    # skipped whenever a saved model is used
+    if st.session_state.csv_data_2 is None:
+        with fnc.span('ingestion', files=len(csv_filenames)):
+            csv_data, _ = fnc.load_data(data_path, csv_filenames, [])
+        for df in csv_data:
+            df['NumericType'] = fnc.encode_labels(df['Type'], class_mapping)
+        st.session_state.csv_data_2 = csv_data
+    return st.session_state.csv_data_2
+
+
+def load_fcs_shape():
+    # Sampled shapefile labels, only built when training or drawing them
+    if st.session_state.fcs_shape_2 is None:
+        with fnc.span('ingestion', files=sum(len(group) for group in shape_filenames)):
+            _, st.session_state.shape_data_2 = fnc.load_data(data_path, [], shape_filenames)
+        st.session_state.fcs_shape_2 = fnc.create_fc_shape(st.session_state.shape_data_2, dates, bands=bands)
+    return st.session_state.fcs_shape_2
+
+
 with st.container():
     if st.session_state.model_2 == None:
-        bar = st.progress(0, text="Checking if data files exist...")
-        # Check if data exists
-        success = fnc.check_data_exists(data_path, csv_filenames, shape_filenames)
-        if success:
+        progress = st.empty()
+
+        # Only runs when no artifact matches the data and settings, so a cold
+        # session with a saved model skips the data preparation entirely
+        def train():
+            bar = progress.progress(0, text="Checking if data files exist...")
+            # Check if data exists
+            if not fnc.check_data_exists(data_path, csv_filenames, shape_filenames):
+                st.stop()
             bar.progress(25, text="Data exists! Loading in data...")
-            # Load in the data
-            st.session_state.csv_data_2, st.session_state.shape_data_2 = fnc.load_data(data_path, csv_filenames, shape_filenames)
+            csv_data = load_csv_data()
             bar.progress(50, text="Data loaded! Creating feature collection...")
             # Create data
-            fcs_csv = fnc.create_fc_csv(st.session_state.csv_data_2, csv_filenames, class_mapping, bands)
-            st.session_state.fcs_shape_2 = fnc.create_fc_shape(st.session_state.shape_data_2, dates)
-            all_fcs = fcs_csv + st.session_state.fcs_shape_2
+            fcs_csv = fnc.create_fc_csv(csv_data, csv_filenames, class_mapping, bands)
+            all_fcs = fcs_csv + load_fcs_shape()
             bar.progress(75, text='Feature collection created! Training the model...')
-            # Train the model
             data = ee.FeatureCollection(all_fcs).flatten().randomColumn(seed=0)
-            st.session_state.model_2 = ee.Classifier.smileRandomForest(50).train(data, 'class', bands)
-            bar.progress(100, text='Model trained!')
-    else:
-        bar = st.progress(100, text="Using existing trained model.")
+            return ee.Classifier.smileRandomForest(50).train(data, 'class', bands)
+
+        key = fnc.pretrained_key(data_path, bands, class_mapping, csv_filenames=csv_filenames,
+                                 shape_filenames=shape_filenames, dates=dates, numtrees=50)
+        st.session_state.model_2, st.session_state.metrics_2 = fnc.get_pretrained_model(key, train)
+        progress.empty()
+
+# Artifacts saved before importance was exported have none
+importance_2 = fnc.rank_importance((st.session_state.metrics_2 or {}).get('importance'), bands)
+fnc.importance_panel(importance_2)
 
 # Set column layout
 col1, col2 = st.columns([4, 1])
 
 with col2:
-    print("===============RELOAD===============")
-
-    # List of CA counties
+    # List of CA counties (bundled index, no Earth Engine calls)
     counties = ee.FeatureCollection('TIGER/2018/Counties')
-    ca_counties = counties.filter(ee.Filter.eq('STATEFP', '06'))
-    ca_counties_list = sorted(ca_counties.aggregate_array('NAME').getInfo())
+    ca_counties_list = ca_counties.county_names()
 
     # Let user pick a CA county
     option = st.selectbox('Select a California county:', ca_counties_list, index=None, placeholder="Los Angeles", help=fnc.tooltip_county)
     if not option:
-        selected_county_centroid = fnc.get_centroid_coordinates('Los Angeles', counties)
+        selected_county_centroid = ca_counties.county_centroid('Los Angeles')
     else:
-        selected_county_centroid = fnc.get_centroid_coordinates(option, counties)
+        selected_county_centroid = ca_counties.county_centroid(option)
 
     # Calculate coordinates for selected CA county, default otherwise
     longitude = selected_county_centroid[0]
@@ -134,13 +157,18 @@ with col2:
     # Format dates to strings
     start_date = start_date.strftime("%Y-%m-%d")
     end_date = end_date.strftime("%Y-%m-%d")
-    print(f'DATE: {start_date} to {end_date}')
+
+    # Let user pick how the scenes are composited
+    method = st.selectbox("Composite method:", fnc.COMPOSITE_METHODS, index=0, help=fnc.tooltip_composite)
+    percentile = 50
+    if method == 'percentile':
+        percentile = st.slider("Percentile:", min_value=5, max_value=95, value=50, step=5)
+    composite = (method, percentile)
 
     with st.spinner('Loading...'):
-        # Create ground truth layers (labeled CSV points for visualization)
+        # Create ground truth layers (shape data; CSV points are drawn client side below)
         layers = {}
         if st.session_state.layers_2 == None:
-            print("Creating gound truth layers...")
             # Define a dictionary of style properties per class type
             class_styles = ee.Dictionary({
                 '0': {'color': '1e90ff', 'width': 1, 'fillColor': 'red', 'pointSize': 5, 'pointShape': 'circle'},    # hoop
@@ -149,31 +177,8 @@ with col2:
                 '3': {'color': '1e90ff', 'width': 1, 'fillColor': 'yellow', 'pointSize': 5, 'pointShape': 'circle'}   # green house
             })
 
-            # Create ground truth layer(s) for CSV data
-            for df, filename in zip(st.session_state.csv_data_2, csv_filenames):
-                points = fnc.get_data_as_points(df)
-                points_layer = ee.FeatureCollection(points)
-
-                # Map a function over the FeatureCollection to set the style property
-                points_layer = points_layer.map(
-                    lambda feature: feature.set(
-                        'style',
-                        class_styles.get(
-                            ee.Number(feature.get('class')).format()  # Convert the class number to string to use as key
-                        )
-                    )
-                )
-
-                # Style the FeatureCollection according to each feature's 'style' property.
-                style_points_layer = points_layer.style(
-                    styleProperty='style',
-                    neighborhood=8
-                )
-
-                layers[filename] = geemap.ee_tile_layer(style_points_layer, {}, filename)
-
             # Create ground truth layer(s) for shape data
-            for fc_shape, filename in zip(st.session_state.fcs_shape_2, [group[0] for group in shape_filenames]):
+            for fc_shape, filename in zip(load_fcs_shape(), [group[0] for group in shape_filenames]):
                 # Map a function over the FeatureCollection to set the style property
                 fc_shape = fc_shape.map(
                     lambda feature: feature.set(
@@ -190,43 +195,41 @@ with col2:
                     neighborhood=8
                 )
 
-                layers[filename] = geemap.ee_tile_layer(style_points_layer, {}, filename)
+                with fnc.span('tile layers', layer=filename):
+                    layers[filename] = fnc.tile_layer(style_points_layer, {}, filename)
             st.session_state.layers_2 = layers
-        else:
-            print("Ground truth layers already created.")
         
         # County to classify on
         county = 'Los Angeles'
         if option:
             county = option
-        # Check if the county or date range has changed
-        if (county != st.session_state.county_2) or (st.session_state.start_date_2 != start_date) or (st.session_state.end_date_2 != end_date):
+        # Check if the county, date range or composite method has changed
+        if (county != st.session_state.county_2) or (st.session_state.start_date_2 != start_date) or (st.session_state.end_date_2 != end_date) or (st.session_state.composite_2 != composite):
             selected_county = counties.filter(ee.Filter.eq('NAME', county))
             roi = selected_county.geometry()
-            processedCollection = fnc.processImageCollection(ee.ImageCollection('COPERNICUS/S2_SR'), roi, start_date, end_date)
-            image = processedCollection.median().clip(roi)
-            print(f'COUNTY: Classifying on {county}.')
+            image = fnc.get_composite('COPERNICUS/S2_SR', roi, start_date, end_date, bands=bands, method=method, percentile=percentile)
 
             # Classify
-            classified_RF = image.select(bands).classify(st.session_state.model_2)
-            accuracy_RF = st.session_state.model_2.confusionMatrix()
-            print(f"RESULTS: RF Resubstitution error matrix: {accuracy_RF.getInfo()}")
-            print(f"RESULTS: RF Training overall accuracy: {accuracy_RF.accuracy().getInfo()}")
+            with fnc.span('classification', county=county, start=start_date, end=end_date):
+                classified_RF = image.select(bands).classify(st.session_state.model_2)
+            print(f"RESULTS: RF Resubstitution error matrix: {st.session_state.metrics_2.get('matrix')}")
+            print(f"RESULTS: RF Training overall accuracy: {st.session_state.metrics_2.get('accuracy')}")
+            print(f"RESULTS: RF Feature importance: {fnc.format_importance(importance_2)}")
 
             # Update the session state with the current values
             st.session_state.county_2 = county
             st.session_state.start_date_2 = start_date
+            st.session_state.composite_2 = composite
             st.session_state.end_date_2 = end_date
             st.session_state.image_2 = image
             st.session_state.classified_RF_2 = classified_RF
-        else:
-            print(f'No change in county or date range. Using previous image for: {st.session_state.county_2}')
 
         palette = ['red', 'green', 'blue', 'yellow']
 
-        # Map slider
-        st.session_state.layers_2["Sentinel-2 RGB"] = geemap.ee_tile_layer(st.session_state.image_2.select(bands), {'min': 0, 'max': 0.3, 'gamma': 1.4}, "Sentinel-2 RGB")
-        st.session_state.layers_2["Classification"] = geemap.ee_tile_layer(st.session_state.classified_RF_2, {'min': 0, 'max': 3, 'palette': palette}, "Classification")
+        # Map slider (each new tile layer is a blocking getMapId request; repeats come from fnc.tile_cache)
+        with fnc.span('tile layers', count=2):
+            st.session_state.layers_2["Sentinel-2 RGB"] = fnc.tile_layer(st.session_state.image_2.select(bands), {'min': 0, 'max': 0.3, 'gamma': 1.4}, "Sentinel-2 RGB")
+            st.session_state.layers_2["Classification"] = fnc.tile_layer(st.session_state.classified_RF_2, {'min': 0, 'max': 3, 'palette': palette}, "Classification")
 
         options = list(st.session_state.layers_2.keys())
         left = st.selectbox("Select a left layer:", options, index=len(options) - 2, help=fnc.tooltip_left_layer)
@@ -234,6 +237,10 @@ with col2:
         left_layer = st.session_state.layers_2[left]
         right_layer = st.session_state.layers_2[right]
         Map.split_map(left_layer, right_layer)
+
+        # Ground truth layer(s) for CSV data
+        for df, filename in zip(load_csv_data(), csv_filenames):
+            fnc.ground_truth_layer(df, filename).add_to(Map)
         
         # Add legend
         legend_titles = ['Hoop', 'Mulch', 'Other', 'Green House']
@@ -245,7 +252,10 @@ with col1:
 
     # Display CSV dataframes
     tabs = st.tabs(csv_filenames)
-    for df, tab, filename in zip(st.session_state.csv_data_2, tabs, csv_filenames):
+    for df, tab, filename in zip(load_csv_data(), tabs, csv_filenames):
         with tab:
             st.write(f"Contents of the file {filename}.csv:")
             st.dataframe(df)
+
+fnc.session_panel()
+fnc.performance_panel(timer)